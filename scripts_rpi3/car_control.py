@@ -1,5 +1,4 @@
 from enum import Enum, IntEnum
-from raspythoncar.wr_lib2wd import WR2WD
 import time
 
 
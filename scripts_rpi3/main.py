@@ -4,28 +4,106 @@ import yaml
 from threading import Thread, Lock, Event
 import queue
 import numpy as np
+import cv2
 import time
 
 import car_control
 
 from util.webcam import webcam, img_from_dir
-from util.client import Client
-
-from raspythoncar.wr_lib2wd import WR2WD
+from util.client import Client, AsyncClient
+from util.qrcode import detect_roi
+from util.adaptive import AdaptiveQuality
+from util.trace import LatencyStats
 
 
 class Client_webcam:
-    def __init__(self, host='localhost', port=5556, timeout=1000, device=0, file_dir=None, zmq_mode=3):
-        self.cl = Client(host, port, timeout, zmq_mode)
+    def __init__(self, host='localhost', port=5556, timeout=1000, device=0, file_dir=None, zmq_mode=3, window=0,
+                 roi_upload=False, locate_scale=1, thumbnail_scale=0, adaptive=None, binary_reply=False,
+                 heartbeat=500, backoff=(10, 1000), trace_window=0, deadline=0):
+        # window > 0: keep up to `window` frames in flight on the server
+        self.window = window
+        # roi_upload: locate the QR code here and upload only the ROI
+        # (+ a 1/thumbnail_scale thumbnail for the server preview)
+        self.roi_upload = roi_upload
+        self.locate_scale = locate_scale
+        self.thumbnail_scale = thumbnail_scale
+        # adaptive: kwargs of AdaptiveQuality, JPEG quality/resolution follow the measured latency
+        self.controller = None
+        if adaptive is not None:
+            self.controller = AdaptiveQuality(timeout=timeout / 1000, **adaptive)
+        # trace_window > 0: per-stage latency over the last trace_window judgements
+        self.stats = LatencyStats(trace_window) if trace_window > 0 else None
+        if (window > 0):
+            self.cl = AsyncClient(host, port, timeout, zmq_mode, window, controller=self.controller,
+                                  binary_reply=binary_reply, heartbeat=heartbeat, backoff=backoff, stats=self.stats,
+                                  deadline=deadline)
+        else:
+            self.cl = Client(host, port, timeout, zmq_mode, controller=self.controller,
+                             binary_reply=binary_reply, heartbeat=heartbeat, backoff=backoff, stats=self.stats,
+                             deadline=deadline)
         if (file_dir is None):
             self.cam = webcam(device)
         else:
             self.cam = img_from_dir(file_dir)
 
     def classify(self):
+        if (self.window == 0):
+            img = self.capture()
+            if not self.roi_upload:
+                return self.cl.send_img(img)
+            roi = self.locate(img)
+            return None if roi is None else self.cl.send_roi(*roi)
+
+        # capture/encode the next frame while the server works on the previous ones,
+        # then take the newest finished result without waiting for it
+        submitted = False
+        if self.cl.ready():
+            img = self.capture()
+            if not self.roi_upload:
+                submitted = self.cl.submit(img) is not None
+            else:
+                roi = self.locate(img)
+                submitted = roi is not None and self.cl.submit_roi(*roi) is not None
+        return self.cl.poll(0 if submitted else 10)
+
+    def capture(self):
+        t0 = time.time()
         img = self.cam.get_img()
-        data = self.cl.send_img(img)
-        return data
+        if self.stats is not None:
+            self.stats.add('capture', time.time() - t0)
+        if img is None or self.controller is None:
+            return img
+        size = self.controller.size
+        if hasattr(self.cam, 'set_size') and self.cam.size != size:
+            self.cam.set_size(*size)
+        if (img.shape[1], img.shape[0]) != size:
+            # camera without that mode, or the frame grabbed before the switch
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        return img
+
+    def locate(self, img):
+        # -> arguments of send_roi, or None when there is no readable QR code
+        if img is None:
+            return None
+        (code, rect), (roi, roi_rect) = detect_roi(img, scale=self.locate_scale)
+        if roi is None:
+            return None
+        thumb = None
+        if self.thumbnail_scale > 0:
+            thumb = cv2.resize(img, (img.shape[1] // self.thumbnail_scale, img.shape[0] // self.thumbnail_scale),
+                               interpolation=cv2.INTER_AREA)
+        return roi, code, rect, roi_rect, thumb, img.shape
+
+    def flush(self):
+        # results of frames captured before a judgement must not trigger the next one
+        if (self.window > 0):
+            self.cl.flush()
+
+
+def adaptive_params(adaptive):
+    if adaptive is None or not adaptive.get('enable', False):
+        return None
+    return {k: v for k, v in adaptive.items() if k != 'enable'}
 
 
 def main():
@@ -40,18 +118,32 @@ def main():
         port=params['client']['port'],
         device=params['client']['device'],
         timeout=params['client']['timeout'],
-        zmq_mode=3
+        zmq_mode=params['client']['zmq_mode'],
+        window=params['client']['window'],
+        roi_upload=params['client']['roi_upload'],
+        locate_scale=params['client']['locate_scale'],
+        thumbnail_scale=params['client']['thumbnail_scale'],
+        adaptive=adaptive_params(params['client'].get('adaptive')),
+        binary_reply=params['client'].get('binary_reply', False),
+        heartbeat=params['client'].get('heartbeat', 500),
+        backoff=params['client'].get('backoff', (10, 1000)),
+        trace_window=params['client'].get('trace', 0),
+        deadline=params['client'].get('deadline', 0)
     )
     print("connected")
-    # setup driver
+    # setup driver (the hardware library is imported after the client is up)
+    from raspythoncar.wr_lib2wd import WR2WD
     wr = WR2WD()
     driver = car_control.Driver(wr)
 
     # main loop
+    t_wait = None
     try:
         while True:
             driver.update()
             if driver.state == car_control.State.WAIT_FOR_JUDGE:
+                if t_wait is None:
+                    t_wait = time.time()
                 data = client_webcam.classify()
                 if data is None or data['pred'] is None:
                     continue
@@ -59,7 +151,17 @@ def main():
                     driver.ant()
                 else:
                     driver.bee()
+                # WAIT_FOR_JUDGE -> ant()/bee()
+                if client_webcam.stats is not None:
+                    client_webcam.stats.add('judge', time.time() - t_wait)
+                t_wait = None
+                client_webcam.flush()
     except KeyboardInterrupt as e:
+        cl = client_webcam.cl
+        print('reconnects:', cl.reconnects, 'lost frames:', cl.lost_frames, 'skipped frames:', cl.skipped_frames,
+              'dropped frames:', cl.dropped_frames)
+        if client_webcam.stats is not None:
+            client_webcam.stats.dump('client')
         print('done.')
 
 
@@ -0,0 +1,104 @@
+class AdaptiveQuality:
+    '''
+    JPEG quality and capture resolution control from measured latency.
+
+    The controlled latency is the round trip minus the server processing
+    time, i.e. the part that encode cost and payload size can change.
+    Above target it first lowers the quality, then the resolution; below
+    target it restores resolution first, then quality. One step per
+    `cooldown` replies, and lost frames count as a full timeout.
+
+    The resolution never goes below the density at which the last seen QR
+    code still covers margin * th_area pixels, the area detect_roi needs to
+    accept it. Until a QR code has been seen it stays at full resolution.
+    '''
+    def __init__( self, target=0.3, quality=(40, 90), q_step=10, resolutions=((1280, 720), (960, 540), (640, 360)),
+                  th_area=20*20, margin=2.0, cooldown=3, alpha=0.3, timeout=10.0, q_init=75 ):
+        self.target = target
+        self.q_min, self.q_max = quality
+        self.q_step = q_step
+        self.resolutions = [ tuple(r) for r in resolutions ]
+        self.th_area = th_area
+        self.margin = margin
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.timeout = timeout
+
+        self.quality = min( max( q_init, self.q_min ), self.q_max )
+        self.level = 0 # index in resolutions
+        self.latency = None
+        self.qr_area = None # QR area at full resolution
+        self.wait = 0
+
+        # last measurement
+        self.encode_time = 0.0
+        self.nbytes = 0
+        self.rtt = 0.0
+
+    @property
+    def size( self ):
+        return self.resolutions[self.level]
+
+    def ratio( self, level ):
+        return self.resolutions[level][0] / self.resolutions[0][0]
+
+    def max_level( self ):
+        # lowest resolution (highest level) that keeps the QR code decodable
+        if( self.qr_area is None ):
+            return 0
+        level = 0
+        for i in range(len(self.resolutions)):
+            if( self.qr_area * self.ratio(i)**2 >= self.th_area * self.margin ):
+                level = i
+        return level
+
+    def update( self, encode_time, nbytes, rtt, server_time=0.0, rect=None, level=None ):
+        '''
+        rtt: None for a lost frame.
+        rect: QR rect found in the frame, in the coordinates of the frame
+        as it was sent at resolution `level` (default: the current one).
+        '''
+        if( level is None ):
+            level = self.level
+
+        self.encode_time = encode_time
+        self.nbytes = nbytes
+        self.rtt = self.timeout if rtt is None else rtt
+
+        if( rect is not None ):
+            area = rect[2] * rect[3] / self.ratio(level)**2
+            self.qr_area = area if self.qr_area is None else \
+                (1-self.alpha) * self.qr_area + self.alpha * area
+
+        latency = self.rtt if rtt is None else max( rtt - server_time, 0.0 )
+        self.latency = latency if self.latency is None else \
+            (1-self.alpha) * self.latency + self.alpha * latency
+
+        if( rtt is not None and self.wait > 0 ):
+            self.wait -= 1
+            return
+
+        max_level = self.max_level()
+        if( self.level > max_level ):
+            # a smaller QR code in view raised the floor
+            self.level = max_level
+            self.wait = self.cooldown
+            return
+
+        if( rtt is None or self.latency > self.target * 1.2 ):
+            if( self.quality > self.q_min ):
+                self.quality = max( self.quality - self.q_step, self.q_min )
+            elif( self.level < max_level ):
+                self.level += 1
+            else:
+                return
+            self.wait = self.cooldown
+
+        elif( self.latency < self.target * 0.7 ):
+            if( self.level > 0 ):
+                self.level -= 1
+            elif( self.quality < self.q_max ):
+                self.quality = min( self.quality + self.q_step, self.q_max )
+            else:
+                return
+            self.wait = self.cooldown
@@ -0,0 +1,171 @@
+import io
+import json
+import mmap
+import zipfile
+import numpy as np
+
+# The head of train.train_model as plain arrays
+#
+#   StandardScaler + LinearSVC            d = x @ weight.T + bias, P(classes[1]) = expit(d)
+#   the same in CalibratedClassifierCV    d for every fold, P(classes[1]) = mean(expit(-(a*d + b)))
+#   (sigmoid calibration)
+#
+# The scaler is folded into weight and bias, so the features go in as the
+# backbone returns them. Only numpy is needed; the sklearn objects are read
+# through their fitted attributes.
+#
+# save_head() writes the arrays and a JSON metadata string to an uncompressed
+# .npz; load_head() memory-maps it and predicts with one matrix product,
+# without importing sklearn.
+
+def expit( x ):
+    return 1 / ( 1 + np.exp( -x ) )
+
+def predict_confidence( model, X ):
+    '''
+    -> labels, confidence of each label ([0.5, 1] for two classes)
+    Calibrated probabilities when the model has predict_proba (see
+    train.calibration); otherwise the logistic of the decision function,
+    which only ranks the samples.
+    '''
+    if( hasattr( model, 'predict_proba' ) ):
+        proba = model.predict_proba( X )
+        k = proba.argmax( axis=1 )
+        return model.classes_[k], proba[ np.arange(len(k)), k ]
+    if( hasattr( model, 'decision_function' ) ):
+        d = model.decision_function( X )
+        if( d.ndim == 1 ):
+            return model.classes_[ (d > 0).astype(int) ], 1 / ( 1 + np.exp( -np.abs(d) ) )
+        k = d.argmax( axis=1 )
+        return model.classes_[k], 1 / ( 1 + np.exp( -d[ np.arange(len(k)), k ] ) )
+    return model.predict( X ), np.ones( X.shape[0] )
+
+def fold_pipeline( model ):
+    # [scaler,] linear classifier -> weight (D,), bias
+    steps = [ s[1] for s in getattr( model, 'steps', [ (None, model) ] ) ]
+    clf = steps[-1]
+    coef = np.asarray( clf.coef_, dtype=np.float64 )
+    intercept = np.asarray( clf.intercept_, dtype=np.float64 )
+    if( coef.shape[0] != 1 ):
+        raise ValueError( 'only binary heads can be folded, got {} classes'.format(coef.shape[0]) )
+    weight = coef[0]
+    bias = intercept[0]
+    for scaler in steps[:-1]:
+        if( not hasattr( scaler, 'scale_' ) or not hasattr( scaler, 'mean_' ) ):
+            raise ValueError( 'can not fold {}'.format(type(scaler).__name__) )
+        # w . (x - mean) / scale + b = (w / scale) . x + (b - w . mean / scale)
+        if( getattr( scaler, 'with_std', True ) and scaler.scale_ is not None ):
+            weight = weight / scaler.scale_
+        if( getattr( scaler, 'with_mean', True ) and scaler.mean_ is not None ):
+            bias = bias - weight @ scaler.mean_
+    return weight, bias
+
+def fold_linear( model ):
+    '''
+    -> dict( weight (K, D), bias (K,), a, b (K,) or None, classes )
+    K is 1, or the number of calibration folds.
+    '''
+    calibrated = getattr( model, 'calibrated_classifiers_', None )
+    if( calibrated is None ):
+        weight, bias = fold_pipeline( model )
+        return dict( weight=weight[np.newaxis], bias=np.array([bias]), a=None, b=None,
+                     classes=np.asarray( model.classes_ ) )
+
+    weights, biases, a, b = [], [], [], []
+    for cc in calibrated:
+        # attribute names differ between sklearn versions
+        estimator = getattr( cc, 'estimator', None ) or getattr( cc, 'base_estimator' )
+        calibrators = getattr( cc, 'calibrators', None ) or getattr( cc, 'calibrators_' )
+        calibrator = calibrators[0]
+        if( not hasattr( calibrator, 'a_' ) ):
+            raise ValueError( 'only sigmoid calibration can be folded' )
+        w, c = fold_pipeline( estimator )
+        weights.append( w )
+        biases.append( c )
+        a.append( calibrator.a_ )
+        b.append( calibrator.b_ )
+    return dict( weight=np.stack( weights ), bias=np.array( biases ), a=np.array( a ), b=np.array( b ),
+                 classes=np.asarray( model.classes_ ) )
+
+def head_proba( head, X ):
+    '''
+    (N, 2) class probabilities of features X, as the exported graphs compute
+    them; expit of the decision function when the head is not calibrated.
+    '''
+    d = X @ head['weight'].T + head['bias']
+    if( head['a'] is None ):
+        p = expit( d[:,0] )
+    else:
+        p = expit( -( head['a'] * d + head['b'] ) ).mean( axis=1 )
+    return np.stack( [ 1 - p, p ], axis=1 )
+
+def save_head( filename, head, meta=None ):
+    arrays = { k: head[k] for k in ( 'weight', 'bias', 'classes' ) }
+    if( head['a'] is not None ):
+        arrays['a'] = head['a']
+        arrays['b'] = head['b']
+    arrays['meta'] = np.array( json.dumps( meta or {} ) )
+    np.savez( filename, **arrays )
+    return filename
+
+def load_npz( filename ):
+    '''
+    Arrays of an uncompressed .npz as read-only views on one mmap of the file
+    (np.load ignores mmap_mode for .npz).
+    '''
+    with open( filename, 'rb' ) as f:
+        buf = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+    arrays = {}
+    with zipfile.ZipFile( filename ) as z:
+        for info in z.infolist():
+            if( info.compress_type != zipfile.ZIP_STORED ):
+                raise ValueError( '{} is compressed'.format(info.filename) )
+            # local file header: 30 bytes, file name, extra field
+            n, m = np.frombuffer( buf, dtype='<u2', count=2, offset=info.header_offset+26 ).tolist()
+            start = info.header_offset + 30 + n + m
+            # npy preamble: magic (6 bytes), version (2), header length (<u2 in v1, <u4 after)
+            size = 2 if buf[start+6] == 1 else 4
+            header_len = int.from_bytes( buf[ start+8 : start+8+size ], 'little' )
+            f = io.BytesIO( buf[ start : start + 8 + size + header_len ] )
+            version = np.lib.format.read_magic( f )
+            if( version == (1, 0) ):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0( f )
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0( f )
+            arrays[ info.filename[:-4] ] = np.ndarray( shape, dtype=dtype, buffer=buf,
+                offset=start+f.tell(), order='F' if fortran else 'C' )
+    return arrays
+
+class NumpyHead:
+    '''
+    Head from save_head() with the sklearn interface predict_confidence()
+    uses: classes_, decision_function, predict.
+    '''
+    def __init__( self, arrays ):
+        self.weight = arrays['weight']
+        self.bias = arrays['bias']
+        self.classes_ = arrays['classes']
+        self.meta = json.loads( str( arrays['meta'] ) )
+
+    def decision_function( self, X ):
+        return ( X @ self.weight.T + self.bias )[:,0]
+
+    def predict( self, X ):
+        return self.classes_[ ( self.decision_function( X ) > 0 ).astype(int) ]
+
+class CalibratedNumpyHead( NumpyHead ):
+    def __init__( self, arrays ):
+        super().__init__( arrays )
+        self.a = arrays['a']
+        self.b = arrays['b']
+
+    def predict_proba( self, X ):
+        p = expit( -( self.a * ( X @ self.weight.T + self.bias ) + self.b ) ).mean( axis=1 )
+        return np.stack( [ 1 - p, p ], axis=1 )
+
+    def predict( self, X ):
+        return self.classes_[ self.predict_proba( X ).argmax( axis=1 ) ]
+
+def load_head( filename ):
+    arrays = load_npz( filename )
+    return CalibratedNumpyHead( arrays ) if 'a' in arrays else NumpyHead( arrays )
@@ -14,23 +14,26 @@ def code2label(code):
         label = None
     return label
 
-def make_squared(img, params):
+def make_squared(img, params, size=IMG_SIZE):
+    # size: (width, height) or the side of the backbone input (config img_size)
+    if isinstance(size, int):
+        size = (size, size)
     if params['method'] == "WHITE_BG":
-        size = max(img.shape[0], img.shape[1])
-        squared_img = np.zeros((size, size, 3), np.uint8)
+        side = max(img.shape[0], img.shape[1])
+        squared_img = np.zeros((side, side, 3), np.uint8)
         squared_img += 255
         squared_img[0:img.shape[0], 0:img.shape[1]] = img
-        squared_img = cv2.resize(squared_img, IMG_SIZE)
+        squared_img = cv2.resize(squared_img, size)
         return squared_img
     elif params['method'] == "CUTOFF":
-        size = min(img.shape[0], img.shape[1])
-        top_bound = img.shape[0] // 2 - size // 2
-        bottom_bound = img.shape[0] // 2 + size // 2
-        left_bound = img.shape[1] // 2 - size // 2
-        right_bound = img.shape[1] // 2 + size // 2
+        side = min(img.shape[0], img.shape[1])
+        top_bound = img.shape[0] // 2 - side // 2
+        bottom_bound = img.shape[0] // 2 + side // 2
+        left_bound = img.shape[1] // 2 - side // 2
+        right_bound = img.shape[1] // 2 + side // 2
 
         squared_img = img[top_bound:bottom_bound, left_bound:right_bound]
-        squared_img = cv2.resize(squared_img, IMG_SIZE)
+        squared_img = cv2.resize(squared_img, size)
         return squared_img
     return img
 
@@ -0,0 +1,259 @@
+import struct
+import json
+import numpy as np
+from pyzbar.locations import Rect
+
+from util.trace import SERVER_STAGES
+
+# Requests
+#   frame: the array frames of one image, as written by send_numpy_array
+#   other: [kind, meta (json), array frames...]
+
+REQUEST_FRAME = b'FRAME'
+REQUEST_ROI = b'ROI'     # QR code located on the client: meta code/rect/roi_rect, arrays [roi, (thumbnail)]
+REQUEST_BATCH = b'BATCH' # several frames, or with meta rois [{code, rect, roi_rect}] several ROIs;
+                         # the reply is {'batch': [result per array], 'server_time'} (JSON)
+
+# frames written by send_numpy_array for one array, per zmq_mode
+FRAMES_PER_ARRAY = { 0:2, 1:1, 2:3, 3:1, 4:2, 5:2 }
+
+# zmq_mode 4: [header, payload]
+#
+# header (little endian)
+#   magic     2s  b'ND'
+#   version   B   wire version, agreed on during the hello
+#   ndim      B
+#   dtype     4s  numpy dtype.str, e.g. b'|u1'
+#   frame_id  Q
+#   t_capture d   time.time() on the sender
+#   t_send    d
+#   shape     ndim * q
+#   strides   ndim * q
+#
+# payload is the raw array memory, sent and received without copies.
+
+WIRE_MAGIC = b'ND'
+WIRE_VERSION = 1
+WIRE_VERSIONS = (1,)
+
+HEADER = struct.Struct('<2sBB4sQdd')
+
+def pack_header( np_array, frame_id=0, t_capture=0.0, t_send=0.0, version=WIRE_VERSION ):
+    ndim = np_array.ndim
+    dtype = np_array.dtype.str.encode('ascii')
+    return HEADER.pack( WIRE_MAGIC, version, ndim, dtype, frame_id, t_capture, t_send ) + \
+        struct.pack( '<{}q'.format(2*ndim), *np_array.shape, *np_array.strides )
+
+def unpack_header( b ):
+    magic, version, ndim, dtype, frame_id, t_capture, t_send = HEADER.unpack_from( b, 0 )
+    if( magic != WIRE_MAGIC or not version in WIRE_VERSIONS ):
+        raise ValueError( 'unknown wire header {} v{}'.format(magic, version) )
+
+    dims = struct.unpack_from( '<{}q'.format(2*ndim), b, HEADER.size )
+    return dict(
+        version = version,
+        dtype = dtype.rstrip(b'\0').decode('ascii'),
+        shape = dims[:ndim],
+        strides = dims[ndim:],
+        frame_id = frame_id,
+        t_capture = t_capture,
+        t_send = t_send,
+    )
+
+def payload( np_array ):
+    '''
+    Array memory as a flat view, without a copy when the array is C or F
+    contiguous. Other layouts (crops, flips) are compacted once.
+    '''
+    if( not ( np_array.flags.c_contiguous or np_array.flags.f_contiguous ) ):
+        np_array = np.ascontiguousarray( np_array )
+    return np_array, np_array.ravel( order='K' )
+
+def pack_array( np_array, frame_id=0, t_capture=0.0, t_send=0.0, version=WIRE_VERSION ):
+    '''
+    [header, payload] for socket.send_multipart(..., copy=False).
+    The array must not be modified until the message has been sent.
+    '''
+    np_array, buf = payload( np_array )
+    header = pack_header( np_array, frame_id, t_capture, t_send, version )
+    return [header, buf]
+
+def unpack_array( frames ):
+    '''
+    frames: [header, payload] as bytes or zmq.Frame (recv_multipart(copy=False)).
+    The array is a read-only view on the received payload.
+    '''
+    header = unpack_header( as_buffer(frames[0]) )
+    np_arr = np.ndarray( shape=header['shape'], dtype=header['dtype'],
+                         buffer=as_buffer(frames[1]), strides=header['strides'] )
+    np_arr.setflags(write=False)
+    return np_arr, header
+
+# zmq_mode 5: [header, slot] with the zmq_mode 4 header, the array itself is
+# in a shared memory segment of the client (util/shm.py)
+#
+# slot (little endian)
+#   name    32s  shared memory name
+#   slot    I
+#   offset  Q    of the array in the segment
+#   seq     Q    frame sequence number, checked against the slot
+
+SHM_SLOT = struct.Struct('<32sIQQ')
+
+def pack_slot( name, slot, offset, seq ):
+    return SHM_SLOT.pack( name.encode('ascii'), slot, offset, seq )
+
+def unpack_slot( b ):
+    name, slot, offset, seq = SHM_SLOT.unpack_from( b, 0 )
+    return name.rstrip(b'\0').decode('ascii'), slot, offset, seq
+
+def as_buffer( f ):
+    # zmq.Frame from recv(copy=False) or bytes
+    b = getattr( f, 'buffer', None )
+    return memoryview(f) if b is None else b
+
+# Replies
+#   json:   the reply dict as JSON (always used for the hello)
+#   binary: [header, timings, trace, text], asked for with meta 'reply' once the
+#           hello reply advertised it
+#
+# header (little endian)
+#   magic      2s  b'RP'
+#   version    B
+#   flags      B   REPLY_* bits: which of the fields below are set
+#   pred       i
+#   confidence f
+#   rect       4i  left, top, width, height
+#   roi_rect   4i
+#   ntimings   B
+# timings    ntimings * f, named by REPLY_TIMINGS in this order
+# trace      v2, when REPLY_TRACE is set: B count, then count * (B stage, d time),
+#            stage indexing util.trace.SERVER_STAGES, time on the server clock
+# tier       v3, when REPLY_TIER is set: B cascade tier that answered
+# text       utf-8 QR code, or the error message when REPLY_ERROR is set
+
+REPLY_MAGIC = b'RP'
+REPLY_JSON = 0
+REPLY_VERSION = 3
+
+REPLY_CODE = 1
+REPLY_RECT = 2
+REPLY_ROI_RECT = 4
+REPLY_PRED = 8
+REPLY_CONFIDENCE = 16
+REPLY_ERROR = 32
+REPLY_TRACE = 64
+REPLY_TIER = 128
+
+REPLY_TIMINGS = ( 'server_time', )
+REPLY_KEYS = { 'code', 'rect', 'roi_rect', 'pred', 'confidence', 'Error' } | set(REPLY_TIMINGS)
+
+REPLY_HEADER = struct.Struct('<2sBBif4i4iB')
+REPLY_STAMP = struct.Struct('<Bd')
+
+def json_reply( data ):
+    # numpy scalars (a pred straight from model.predict) as plain numbers
+    return json.dumps( data, default=lambda o: o.item() if isinstance( o, np.generic ) else str(o) ).encode('utf-8')
+
+def pack_reply( data, version=REPLY_JSON ):
+    '''
+    Reply bytes for the version the client asked for. Replies with fields the
+    binary layout has no place for fall back to JSON.
+    '''
+    if( version < 1 or not isinstance( data, dict ) ):
+        return json_reply( data )
+    version = min( version, REPLY_VERSION )
+    trace = data.get('trace')
+    tier = data.get('tier')
+    keys = data.keys()
+    if( version >= 2 and trace is not None ):
+        keys = keys - {'trace'}
+    if( version >= 3 and tier is not None ):
+        keys = keys - {'tier'}
+    if( not REPLY_KEYS.issuperset( keys ) or ( trace is not None and not set(SERVER_STAGES).issuperset( trace ) ) ):
+        return json_reply( data )
+    pred = data.get('pred')
+    if( pred is not None and not isinstance( pred, ( int, np.integer ) ) ):
+        # the binary layout has an int32 pred
+        return json_reply( data )
+
+    flags = 0
+    if( data.get('Error') is not None ):
+        flags |= REPLY_ERROR
+        # only the exception itself, the traceback stays in the server log
+        text = data['Error'].strip().splitlines()[-1]
+    else:
+        text = data.get('code')
+        if( text is not None ):
+            flags |= REPLY_CODE
+
+    fields = []
+    for bit, key in [ (REPLY_PRED, 'pred'), (REPLY_CONFIDENCE, 'confidence') ]:
+        v = data.get(key)
+        if( v is not None ):
+            flags |= bit
+        fields.append( 0 if v is None else v )
+    for bit, key in [ (REPLY_RECT, 'rect'), (REPLY_ROI_RECT, 'roi_rect') ]:
+        v = data.get(key)
+        if( v is not None ):
+            flags |= bit
+        fields.extend( (0, 0, 0, 0) if v is None else v )
+
+    timings = [ data.get(k, 0.0) for k in REPLY_TIMINGS ]
+    stamps = b''
+    if( trace is not None ):
+        flags |= REPLY_TRACE
+        stamps = bytes( [len(trace)] ) + b''.join(
+            REPLY_STAMP.pack( SERVER_STAGES.index(k), t ) for k, t in trace.items() )
+    if( tier is not None and version >= 3 ):
+        flags |= REPLY_TIER
+        stamps += bytes( [tier] )
+    return REPLY_HEADER.pack( REPLY_MAGIC, version, flags, *fields, len(timings) ) + \
+        struct.pack( '<{}f'.format(len(timings)), *timings ) + stamps + \
+        ( b'' if text is None else text.encode('utf-8') )
+
+def unpack_reply( b ):
+    '''
+    Reply dict from either encoding; rects come back as Rect.
+    '''
+    b = bytes( as_buffer(b) )
+    if( not b.startswith( REPLY_MAGIC ) ):
+        return json.loads( b )
+
+    magic, version, flags, pred, confidence, *rects, ntimings = REPLY_HEADER.unpack_from( b, 0 )
+    if( version > REPLY_VERSION ):
+        raise ValueError( 'unknown reply v{}'.format(version) )
+
+    offset = REPLY_HEADER.size
+    timings = struct.unpack_from( '<{}f'.format(ntimings), b, offset )
+    offset += 4 * ntimings
+    trace = None
+    if( flags & REPLY_TRACE ):
+        trace = {}
+        for i in range( b[offset] ):
+            stage, t = REPLY_STAMP.unpack_from( b, offset + 1 + i*REPLY_STAMP.size )
+            trace[ SERVER_STAGES[stage] ] = t
+        offset += 1 + b[offset] * REPLY_STAMP.size
+    tier = None
+    if( flags & REPLY_TIER ):
+        tier = b[offset]
+        offset += 1
+    text = b[offset:].decode('utf-8')
+
+    if( flags & REPLY_ERROR ):
+        data = { 'Error': text }
+    else:
+        data = {
+            'code': text if flags & REPLY_CODE else None,
+            'rect': Rect( *rects[:4] ) if flags & REPLY_RECT else None,
+            'roi_rect': Rect( *rects[4:] ) if flags & REPLY_ROI_RECT else None,
+            'pred': pred if flags & REPLY_PRED else None,
+        }
+        if( flags & REPLY_CONFIDENCE ):
+            data['confidence'] = confidence
+    data.update( zip( REPLY_TIMINGS, timings ) )
+    if( trace is not None ):
+        data['trace'] = trace
+    if( tier is not None ):
+        data['tier'] = tier
+    return data
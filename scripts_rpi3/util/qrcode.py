@@ -1,13 +1,13 @@
 import os
 import cv2
-import pyqrcode
-import barcode
 from pyzbar.pyzbar import decode
 from pyzbar.locations import Rect
 import numpy as np
 
 # https://qiita.com/igor-bond16/items/0dbef691a71c2e5e37d7
 def generate( ustr, tmp_filename='__qrcode_generate', scale=6, remove=True):
+    # only needed to make cards, not to read them
+    import pyqrcode
     qr = pyqrcode.QRCode(ustr)
     qr.png(tmp_filename+'.png',scale=scale)
     qr_img = cv2.imread(tmp_filename+'.png')
@@ -15,7 +15,11 @@ def generate( ustr, tmp_filename='__qrcode_generate', scale=6, remove=True):
         os.remove( tmp_filename+'.png' )
     return qr_img
 
-def detect( img, th_area=20*20 ):
+def detect( img, th_area=20*20, scale=1 ):
+    # scale > 1: locate on a 1/scale grayscale image, rect in img coordinates
+    if( scale > 1 ):
+        gray = img if img.ndim == 2 else cv2.cvtColor( img, cv2.COLOR_BGR2GRAY )
+        img = cv2.resize( gray, (gray.shape[1]//scale, gray.shape[0]//scale), interpolation=cv2.INTER_AREA )
     data = decode( img )
     if( data is None ):
         return None, None
@@ -31,6 +35,8 @@ def detect( img, th_area=20*20 ):
 
     code = data[0].decode(encoding='utf-8')
     rect = data.rect
+    if( scale > 1 ):
+        rect = Rect( left=rect.left*scale, top=rect.top*scale, width=rect.width*scale, height=rect.height*scale )
 
     if( rect.width * rect.height < th_area ):
         return code, None
@@ -42,14 +48,14 @@ def is_inside( roi, img ):
     return roi.top >= 0 and roi.top + roi.height < s[0] and \
         roi.left >= 0 and roi.left + roi.width < s[1]
 
-def detect_roi( img, size_ratio=None, gap_ratio=None, th_area=None ):
+def detect_roi( img, size_ratio=None, gap_ratio=None, th_area=None, scale=1 ):
     if( size_ratio is None ):
         size_ratio = (1.6, 1.6)
     if( gap_ratio is None ):
         gap_ratio = 0.25
     if( th_area is None ):
         th_area = 20*20
-    code, rect = detect( img, th_area )
+    code, rect = detect( img, th_area, scale )
 
     if( rect is None ):
         return (code, None), (None, None)
@@ -4,57 +4,43 @@ import zmq
 import numpy as np
 import json
 import datetime
+import time
 import socket
 import traceback
 import os
+import collections
+import multiprocessing
+import threading
 
-import zlib
-try:
-   import cPickle as pickle
-except:
-   import pickle
-
-try:
-    # python 2
-    from StringIO import StringIO as io_memory
-except ImportError:
-    # python 3
-    from io import BytesIO as io_memory
-
-from PIL import Image
+from util.protocol import WIRE_VERSION, REQUEST_FRAME, REQUEST_ROI, REQUEST_BATCH, FRAMES_PER_ARRAY, unpack_array, as_buffer
+from util.protocol import REPLY_JSON, REPLY_VERSION, pack_reply, unpack_header, unpack_slot
+from util.shm import FrameReader
+from util.jpeg import JpegDecoder
+from util import trace
 
 # https://www.it-swarm-ja.tech/ja/python/python%E3%81%AEstdlib%E3%82%92%E4%BD%BF%E3%81%A3%E3%81%A6%E3%83%AD%E3%83%BC%E3%82%AB%E3%83%ABip%E3%82%A2%E3%83%89%E3%83%AC%E3%82%B9%E3%82%92%E8%A6%8B%E3%81%A4%E3%81%91%E3%82%8B/958373570/
 def ip():
     return ((([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")] or [[(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + ["no IP found"])[0])
 
-def receive_numpy_array( socket, mode ):
+# zmq_mode 5 segments mapped by this process
+shm_reader = FrameReader()
+
+def unpack_numpy_array( frames, mode, decoder=None, slot=0 ):
     if( mode == 0 ):
         # https://pyzmq.readthedocs.io/en/latest/serialization.html
         try:
-            md = socket.recv_json()
-            msg = socket.recv()
-        except KeyboardInterrupt as e:
-            raise( e )
-        except:
-            return None
-
-        try:
-            buf = memoryview(msg)
+            md = json.loads( bytes(as_buffer(frames[0])) )
+            buf = as_buffer(frames[1])
             np_arr = np.frombuffer(buf, dtype=md['dtype'])
             np_arr.shape = md['shape']
         except:
             np_arr = None
 
     elif( mode == 1 ):
+        import zlib
+        import pickle
         try:
-            z = socket.recv()
-        except KeyboardInterrupt as e:
-            raise( e )
-        except:
-            return None
-
-        try:
-            p = zlib.decompress(z)
+            p = zlib.decompress(as_buffer(frames[0]))
             np_arr = pickle.loads(p)
         except:
             np_arr = None
@@ -62,35 +48,98 @@ def receive_numpy_array( socket, mode ):
     elif( mode == 2 ):
         # https://blog.futurestandard.jp/entry/2017/02/27/151741
         try:
-            [dtype, shape, array] = socket.recv_multipart()
-        except KeyboardInterrupt as e:
-            raise( e )
+            [dtype, shape, array] = [ as_buffer(f) for f in frames ]
+            np_arr = np.frombuffer(array, dtype=bytes(dtype).decode('utf-8'))
+            np_arr.shape = json.loads(bytes(shape).decode('utf-8'))
         except:
-            return None
+            np_arr = None
 
+    elif( mode == 3 ):
+        # BGR, like the rest of the OpenCV pipeline
+        if( decoder is None ):
+            decoder = JpegDecoder()
         try:
-            np_arr = np.frombuffer(array, dtype=dtype.decode('utf-8'))
-            np_arr.shape = json.loads(shape.decode('utf-8'))
+            np_arr = decoder.decode( as_buffer(frames[0]), slot=slot )
         except:
             np_arr = None
 
-    elif( mode == 3 ):
+    elif( mode == 4 ):
+        # binary header + raw array memory, see util/protocol.py
         try:
-            b = socket.recv()
-        except KeyboardInterrupt as e:
-            raise( e )
+            np_arr, header = unpack_array( frames )
         except:
-            return None
+            np_arr = None
 
+    elif( mode == 5 ):
+        # binary header + place of the array in the client's shared memory
         try:
-            img = Image.open( io_memory(b) )
-            np_arr = np.asarray(img)
-            np_arr.setflags(write=False)
+            header = unpack_header( as_buffer(frames[0]) )
+            np_arr = shm_reader.get( *unpack_slot( as_buffer(frames[1]) ), header )
         except:
             np_arr = None
 
+    else:
+        np_arr = None
+
     return np_arr
 
+def receive_numpy_array( socket, mode, decoder=None ):
+    try:
+        frames = socket.recv_multipart(copy=False)
+    except KeyboardInterrupt as e:
+        raise( e )
+    except:
+        return None
+
+    return unpack_numpy_array( frames, mode, decoder )
+
+def unpack_request( frames, mode, decoder=None, slot=0 ):
+    '''
+    -> kind, meta, arrays (see util/protocol.py)
+    kind is None when the request can not be read.
+    slot: decoder slot of the first array; requests handled together must
+    not share slots.
+    '''
+    n = FRAMES_PER_ARRAY.get( mode )
+    if( n is None ):
+        return None, None, None
+
+    if( len(frames) == n ):
+        return REQUEST_FRAME, {}, [ unpack_numpy_array( frames, mode, decoder, slot ) ]
+
+    try:
+        kind = bytes(as_buffer(frames[0]))
+        meta = json.loads( bytes(as_buffer(frames[1])) )
+    except:
+        return None, None, None
+
+    arrays = []
+    for k, i in enumerate( range( 2, len(frames), n ) ):
+        arrays.append( unpack_numpy_array( frames[i:i+n], mode, decoder, slot+k ) )
+    return kind, meta, arrays
+
+def receive_request( socket, mode, decoder=None ):
+    try:
+        frames = socket.recv_multipart(copy=False)
+    except KeyboardInterrupt as e:
+        raise( e )
+    except:
+        return None, None, None
+
+    trace.begin()
+    request = unpack_request( frames, mode, decoder )
+    trace.mark('decode')
+    return request
+
+def split_envelope( frames ):
+    '''
+    [address..., b'', body...] -> [address..., b''], [body...]
+    '''
+    for i, f in enumerate(frames):
+        if( len(f) == 0 ):
+            return frames[:i+1], frames[i+1:]
+    return [], frames
+
 def draw_rect( img, r, c ):
     cv2.rectangle( img, (r.left, r.top), (r.left+r.width, r.top+r.height), c, 2 )
 
@@ -106,126 +155,643 @@ def draw_text( img, text, pos, c, bc ):
     cv2.putText(img, text, (textX, textY), font, 1,  c, 2, cv2.LINE_AA)
 
 
-def server_start( port=5556, func=None, verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], zmq_mode = None ):
+DROPPED_DEADLINE = {'Dropped':'deadline'}
+DROPPED_CONFLATE = {'Dropped':'conflate'}
+
+class ServiceTime:
+    # running mean of the server_time of the replies [s]
+    def __init__( self, alpha=0.2 ):
+        self.alpha = alpha
+        self.value = 0.0
+
+    def add( self, t ):
+        self.value = t if self.value == 0.0 else self.value + self.alpha * ( t - self.value )
+
+    def decay( self ):
+        # only requests that run update the mean, so after a request dropped on
+        # the estimate alone (e.g. one raised by a slow cold start) it is halved
+        self.value /= 2
+
+service_time = ServiceTime()
+
+def stale( meta ):
+    # meta['deadline']: server clock time after which the client has no use for the result.
+    # A request whose result would only be ready after it (inference takes
+    # service_time) is stale as well: the client has given up on it by then, and
+    # serving it would make the requests queued behind it late too.
+    deadline = None if meta is None else meta.get('deadline')
+    return deadline is not None and time.time() + service_time.value > deadline
+
+def handle_request( kind, meta, arrays, func, zmq_mode ):
+    if( kind is None or len(arrays) == 0 or any( a is None for a in arrays ) ):
+        error_message = '***** ERROR: The client may send a wrong data. Check zmq_mode: {} *****'.format(zmq_mode)
+        print(error_message, file=sys.stderr)
+        return {'Error':error_message}
+
+    print('-----')
+    print( 'recv at', datetime.datetime.now() )
+
+    if( kind == REQUEST_FRAME and arrays[0].shape == (1,1,3) ):
+        # time: server clock, for the client's offset estimate
+        # ready: func has finished its warm-up (funcs without one always are)
+        return {'Hello':arrays[0].shape, 'wire':WIRE_VERSION, 'reply':REPLY_VERSION, 'time':time.time(),
+                'ready':bool( getattr( func, 'ready', True ) )}
+
+    if( stale( meta ) ):
+        # checked before QR detection and inference
+        rest = meta['deadline'] - time.time()
+        print( '***** drop: deadline in {:.3f} s, service time {:.3f} s *****'.format(
+            rest, service_time.value ), file=sys.stderr )
+        if( rest > 0 ):
+            service_time.decay()
+        return dict( DROPPED_DEADLINE )
+
+    t0 = time.time()
+    try:
+        if( kind == REQUEST_FRAME ):
+            data = func( arrays[0] )
+        elif( kind == REQUEST_ROI ):
+            # QR code already located by the client
+            data = func.classify_roi( arrays[0], meta )
+        elif( kind == REQUEST_BATCH ):
+            data = { 'batch': handle_batch( func, arrays, meta ) }
+        else:
+            raise ValueError( 'unknown request {}'.format(kind) )
+    except:
+        data = func_error()
+    return finish_reply( data, meta, t0 )
+
+def func_error():
+    # reply for an exception raised by func
+    error_message = traceback.format_exc()
+    print( '***** ERROR in func *****', file=sys.stderr )
+    print( error_message, file=sys.stderr )
+    print( '*************************', file=sys.stderr )
+    return {'Error':error_message}
+
+def finish_reply( data, meta, t0 ):
+    # lets the client tell processing time from network time
+    if( isinstance( data, dict ) ):
+        data['server_time'] = time.time() - t0
+        service_time.add( data['server_time'] )
+
+        # stage timestamps, asked for with the correlation id meta['trace']
+        if( meta.get('trace') is not None ):
+            trace.mark('reply')
+            stamps = trace.stamps()
+            trace.stats.add_stamps( stamps )
+            data['trace'] = stamps
+            print( 'trace', meta['trace'] )
+    return data
+
+def batchable( kind, meta, arrays, func ):
+    # frames and ROIs func can classify together with those of other requests
+    if( kind is None or len(arrays) == 0 or any( a is None for a in arrays ) or stale( meta ) ):
+        return False
+    if( kind == REQUEST_FRAME ):
+        return arrays[0].shape != (1,1,3) and hasattr( func, 'classify_frames' )
+    return kind == REQUEST_ROI and hasattr( func, 'classify_rois' )
+
+def handle_requests( requests, func, zmq_mode ):
+    '''
+    handle_request for [(kind, meta, arrays)] gathered from several clients:
+    their frames go through one func.classify_frames call and their ROIs
+    through one func.classify_rois call (one forward pass each). Everything
+    else (hello, dropped, batch requests, funcs without those methods) is
+    handled one by one.
+    -> data per request
+    '''
+    results = [None] * len(requests)
+    groups = { REQUEST_FRAME: [], REQUEST_ROI: [] }
+    for i, (kind, meta, arrays) in enumerate( requests ):
+        if( batchable( kind, meta, arrays, func ) ):
+            groups[kind].append( i )
+        else:
+            results[i] = handle_request( kind, meta, arrays, func, zmq_mode )
+
+    for kind, index in groups.items():
+        if( not index ):
+            continue
+        print('-----')
+        print( 'recv at', datetime.datetime.now(), len(index), 'requests' )
+        t0 = time.time()
+        try:
+            if( kind == REQUEST_FRAME ):
+                out = func.classify_frames( [ requests[i][2][0] for i in index ] )
+            else:
+                out = func.classify_rois( [ requests[i][2][0] for i in index ], [ requests[i][1] for i in index ] )
+        except:
+            error = func_error()
+            out = [ dict( error ) for i in index ]
+        for i, data in zip( index, out ):
+            results[i] = finish_reply( data, requests[i][1], t0 )
+    return results
+
+def handle_batch( func, arrays, meta ):
+    '''
+    Results of a REQUEST_BATCH, one per array. func.classify_frames /
+    func.classify_rois take the whole batch (one forward pass); other funcs
+    are called once per array.
+    '''
+    rois = meta.get('rois')
+    if( rois is None ):
+        if( hasattr( func, 'classify_frames' ) ):
+            return func.classify_frames( arrays )
+        return [ func( a ) for a in arrays ]
+
+    if( len(rois) != len(arrays) ):
+        raise ValueError( '{} rois for {} arrays'.format(len(rois), len(arrays)) )
+    if( hasattr( func, 'classify_rois' ) ):
+        return func.classify_rois( arrays, rois )
+    return [ func.classify_roi( a, m ) for a, m in zip( arrays, rois ) ]
+
+def is_dropped( data ):
+    return isinstance( data, dict ) and 'Dropped' in data
+
+def encode_reply( data, meta ):
+    # JSON unless the client asked for the binary reply (util/protocol.py)
+    version = REPLY_JSON if meta is None else meta.get( 'reply', REPLY_JSON )
+    try:
+        return pack_reply( data, version )
+    except Exception:
+        # a reply that can not be encoded is answered with the error, the
+        # REQ/ROUTER peer must not be left without an answer
+        traceback.print_exc()
+        return pack_reply( { 'Error': traceback.format_exc() }, version )
+
+def conflate_requests( socket, pending ):
+    '''
+    Move every request waiting on the ROUTER socket into pending
+    (client id -> newest request frames, oldest client first). A request
+    replaced by a newer one from the same client is answered as dropped.
+    '''
+    while( socket.poll(0) ):
+        frames = socket.recv_multipart(copy=False)
+        client = frames[0].bytes
+        old = pending.pop( client, None )
+        if( old is not None ):
+            envelope, body = split_envelope( old )
+            socket.send_multipart( envelope + [json.dumps(DROPPED_CONFLATE).encode('utf-8')], copy=False )
+        pending[client] = frames
+
+class Batcher:
+    '''
+    Dynamic micro-batching: requests waiting on a ROUTER socket, from any
+    client, are served together, at most max_size at a time. After the first
+    request of a batch arrives, others are waited for up to max_delay [ms].
+    Batch sizes and the time requests spent queued are kept as metrics.
+    '''
+    def __init__( self, max_size=8, max_delay=5, window=1000 ):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.arrival = {} # pending key -> (receive time, frames)
+        self.seq = 0
+        self.sizes = collections.Counter()
+        self.stats = trace.LatencyStats( window )
+
+    def receive( self, socket, pending, conflate ):
+        # every waiting request into pending (client id -> frames when conflating)
+        if( conflate ):
+            conflate_requests( socket, pending )
+        else:
+            while( socket.poll(0) ):
+                self.seq += 1
+                pending[self.seq] = socket.recv_multipart(copy=False)
+        t = time.time()
+        for key, frames in pending.items():
+            a = self.arrival.get( key )
+            if( a is None or a[1] is not frames ):
+                self.arrival[key] = ( t, frames )
+
+    def gather( self, socket, pending, conflate=False ):
+        '''
+        -> up to max_size request frames, oldest first
+        '''
+        if( not pending ):
+            socket.poll()
+        t_end = time.time() + self.max_delay / 1000
+        while( True ):
+            self.receive( socket, pending, conflate )
+            rest = t_end - time.time()
+            if( len(pending) >= self.max_size or rest <= 0 or not socket.poll( rest*1000 ) ):
+                break
+        self.receive( socket, pending, conflate )
+
+        t = time.time()
+        batch = []
+        while( pending and len(batch) < self.max_size ):
+            key, frames = pending.popitem( last=False )
+            self.stats.add( 'queue', t - self.arrival.pop( key )[0] )
+            batch.append( frames )
+
+        self.sizes[len(batch)] += 1
+        print( 'batch', len(batch), 'queued', len(pending) )
+        return batch
+
+    def dump( self, file=sys.stdout ):
+        n = sum( self.sizes.values() )
+        if( n == 0 ):
+            return
+        mean = sum( k*v for k, v in self.sizes.items() ) / n
+        print( '----- batches: {} (mean size {:.2f}, max_size {}, max_delay {} ms) -----'.format(
+            n, mean, self.max_size, self.max_delay ), file=file )
+        for k in sorted( self.sizes ):
+            print( 'size {:3d}: {:8d}'.format( k, self.sizes[k] ), file=file )
+        self.stats.dump( 'queueing delay', file )
+
+def preview_image( kind, meta, arrays ):
+    '''
+    Image the result is drawn on: the frame itself, or for ROI requests the
+    thumbnail scaled back to the frame size.
+    '''
+    if( kind == REQUEST_FRAME ):
+        return arrays[0]
+    if( kind == REQUEST_ROI and meta.get('thumb') and meta.get('shape') ):
+        h, w = meta['shape'][:2]
+        return cv2.resize( arrays[1], (w, h) )
+    if( kind == REQUEST_BATCH and meta.get('rois') is None ):
+        return arrays[-1]
+    return None
+
+def preview_result( kind, data ):
+    # result drawn on the preview_image
+    if( kind == REQUEST_BATCH and isinstance( data, dict ) and data.get('batch') ):
+        return data['batch'][-1]
+    return data
+
+def show_result( img, data, verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], writer=None ):
+    # writer: FileWriter for the image files, else they are written here
+    imwrite = cv2.imwrite if writer is None else writer.write
+    try:
+        img0 = img.copy()
+
+        if( verbose ):
+            print(json.dumps(data, indent=2))
+
+        if( imshow or imfile ):
+            c = (255,0,0) #BGR, blur
+            bc = (192,192,192)
+            try:
+                draw_rect( img, data['rect'], c )
+            except:
+                pass
+
+            try:
+                text = data['code']
+                r = data['rect']
+                pos = (r.left+r.width/2, r.top+r.height)
+                draw_text( img, text, pos, c, bc )
+            except:
+                pass
+
+            try:
+                if( data['pred'] < 0.5 ):
+                    c = (255,255,  0) #BGR cyan for dog
+                else:
+                    c = (255,  0,255) #BGR magenta for cat
+                bc = (64,64,64)
+            except:
+                c = (255,0,0) #BGR blue
+                bc = (192,192,192)
+
+            try:
+                draw_rect( img, data['roi_rect'], c )
+            except:
+                pass
+
+            try:
+                text = vs_str[0] if data['pred'] < 0.5 else vs_str[1]
+                text = text + ':{:5.3f}'.format(data['pred'])
+                r = data['roi_rect']
+                pos = (r.left+r.width/2, r.top+r.height)
+                draw_text( img, text, pos, c, bc )
+
+            except:
+                pass
+
+        if( imshow ):
+            cv2.imshow('Hit space key to save image.',img)
+            #cv2.waitKey(1)
+            key = cv2.waitKey(1) & 0xff
+            if( key == ord(' ') ):
+                if( os.path.exists('./capture') == False):
+                    os.mkdir('./capture')
+                imwrite('./capture/'+datetime.datetime.now().strftime("%Y%m%d-%H%M%S")+'.jpg',img0)
+
+
+        if( imfile is not None ):
+            imwrite(imfile,img)
+
+    except:
+        error_message = traceback.format_exc()
+        print( '***** ERROR in server *****', file=sys.stderr )
+        print( error_message, file=sys.stderr )
+        print( '*************************', file=sys.stderr )
+
+class FileWriter:
+    '''
+    cv2.imwrite on a thread of its own. A write waiting for the disk is
+    replaced by a newer image for the same path, so a slow disk only skips
+    preview files; captures have their own names and are all written.
+    '''
+    def __init__( self ):
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict() # path -> image
+        self.closed = False
+        self.thread = threading.Thread( target=self.run, daemon=True )
+        self.thread.start()
+
+    def write( self, path, img ):
+        with self.cond:
+            self.pending.pop( path, None )
+            self.pending[path] = img
+            self.cond.notify()
+        return True
+
+    def run( self ):
+        while( True ):
+            with self.cond:
+                while( not self.pending and not self.closed ):
+                    self.cond.wait()
+                if( not self.pending ):
+                    return
+                path, img = self.pending.popitem( last=False )
+            if( not cv2.imwrite( path, img ) ):
+                print( '***** ERROR: can not write {} *****'.format(path), file=sys.stderr )
+
+    def close( self ):
+        # waits for the writes already queued
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+class Visualizer:
+    '''
+    show_result on a thread of its own, so drawing, imshow/waitKey and file
+    writes never hold up the next request. It is fed through a queue of
+    `size` frames; when it falls behind, the oldest frame is dropped.
+    All GUI calls happen on that thread.
+    '''
+    def __init__( self, verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], size=1 ):
+        self.args = ( verbose, imshow, imfile, vs_str )
+        self.imshow = imshow
+        self.draws = imshow or imfile is not None
+        self.output = verbose or self.draws
+        self.queue = collections.deque( maxlen=size )
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.writer = FileWriter()
+        self.thread = threading.Thread( target=self.run, daemon=True )
+        self.thread.start()
+
+    def put( self, img, data ):
+        if( not self.output ):
+            # nothing shown, written or printed (e.g. broker workers after the first)
+            return
+        if( self.draws ):
+            # a copy: the frame may sit in a decoder buffer, zmq frame or shm slot
+            # that the next request reuses, and show_result draws on it
+            img = img.copy()
+        with self.cond:
+            if( len(self.queue) == self.queue.maxlen ):
+                self.dropped += 1
+            self.queue.append( (img, data) )
+            self.cond.notify()
+
+    def run( self ):
+        while( True ):
+            with self.cond:
+                while( not self.queue and not self.closed ):
+                    self.cond.wait()
+                if( self.closed ):
+                    break
+                img, data = self.queue.popleft()
+            show_result( img, data, *self.args, writer=self.writer )
+        if( self.imshow ):
+            cv2.destroyAllWindows()
+
+    def close( self ):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.writer.close()
+        if( self.dropped > 0 ):
+            print( 'preview: {} frames dropped'.format(self.dropped) )
+
+def endpoints( port, zmq_mode, ipc ):
+    '''
+    Endpoints the server listens on. zmq_mode 5 requests name a file in
+    /dev/shm for the server to map, which only clients on this machine may
+    do: they are served on the ipc endpoint alone.
+    '''
+    if( zmq_mode != 5 ):
+        return [ f'tcp://*:{port}' ] + ( [] if ipc is None else [ipc] )
+    if( ipc is None ):
+        raise ValueError( 'zmq_mode 5 is served on the ipc endpoint only, set one' )
+    print( 'zmq_mode 5: listening on', ipc, 'only' )
+    return [ipc]
+
+def server_start( port=5556, func=None, verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], zmq_mode = None, jpeg_backend=None, conflate=False, ipc=None,
+                  batch_size=1, batch_delay=5 ):
+    '''
+    conflate: serve only the newest waiting request of every client;
+    older ones are answered {'Dropped':'conflate'} without being run.
+    ipc: also listen on this endpoint (e.g. ipc:///tmp/server), for clients
+    on the same machine; with zmq_mode 5 the only one (see endpoints).
+    batch_size > 1: frames/ROIs of up to batch_size clients are classified in
+    one batch (see Batcher), waiting at most batch_delay [ms] for them.
+    '''
     print( 'host: ', ip() )
     print( 'port: ', port )
-    bind = f'tcp://*:{port}'
 
+    batcher = Batcher( batch_size, batch_delay ) if batch_size > 1 else None
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER if conflate or batcher is not None else zmq.REP)
     socket.setsockopt(zmq.LINGER, 10)
-    socket.bind(bind)
+    for endpoint in endpoints( port, zmq_mode, ipc ):
+        socket.bind(endpoint)
+    decoder = JpegDecoder( jpeg_backend )
+    pending = collections.OrderedDict()
+    viz = Visualizer( verbose, imshow, imfile, vs_str )
     print("Server startup.")
 
     while( True ):
         try:
-            img = receive_numpy_array( socket, zmq_mode )
+            if( batcher is not None ):
+                batch = batcher.gather( socket, pending, conflate )
+            elif( conflate ):
+                if( not pending ):
+                    socket.poll()
+                conflate_requests( socket, pending )
+                batch = [ pending.popitem( last=False )[1] ]
+            else:
+                batch = None
+                kind, meta, arrays = receive_request( socket, zmq_mode, decoder )
         except KeyboardInterrupt:
             print()
             break
 
-        if( img is None ):
-            '''
-            socket.close()
-            socket = context.socket(zmq.REP)
-            socket.setsockopt(zmq.LINGER, 10)
-            socket.bind(bind)
-            '''
-            error_message = '***** ERROR: The client may send a wrong data. Check zmq_mode: {} *****'.format(zmq_mode)
-            print(error_message, file=sys.stderr)
-            data = {'Error':error_message}
-            socket.send_json(data)
-
+        if( batch is None ):
+            data = handle_request( kind, meta, arrays, func, zmq_mode )
+            socket.send( encode_reply( data, meta ) )
+            done = [ (kind, meta, arrays, data) ]
         else:
-            print('-----')
-            print( 'recv at', datetime.datetime.now() )
-
-            if( img.shape == (1,1,3) ):
-                data = {'Hello':img.shape}
+            trace.begin()
+            envelopes, requests = [], []
+            slot = 0
+            for frames in batch:
+                envelope, body = split_envelope( frames )
+                envelopes.append( envelope )
+                requests.append( unpack_request( body, zmq_mode, decoder, slot ) )
+                slot += len( requests[-1][2] or [] )
+            trace.mark('decode')
+            if( batcher is None ):
+                results = [ handle_request( *requests[0], func, zmq_mode ) ]
             else:
-                try:
-                    data = func( img )
-                except:
-                    error_message = traceback.format_exc()
-                    print( '***** ERROR in func *****', file=sys.stderr )
-                    print( error_message, file=sys.stderr )
-                    print( '*************************', file=sys.stderr )
-                    data = {'Error':error_message}
-
-            socket.send_json(data)
-            print( 'send at', datetime.datetime.now() )
+                results = handle_requests( requests, func, zmq_mode )
+            done = []
+            for envelope, (kind, meta, arrays), data in zip( envelopes, requests, results ):
+                socket.send_multipart( envelope + [encode_reply( data, meta )] )
+                done.append( (kind, meta, arrays, data) )
+
+        # only the newest result of a batch is previewed
+        preview = None
+        for kind, meta, arrays, data in done:
+            if( kind is not None and not is_dropped( data ) ):
+                print( 'send at', datetime.datetime.now() )
+                img = preview_image( kind, meta, arrays )
+                if( img is not None ):
+                    preview = ( img, preview_result( kind, data ) )
+        if( preview is not None ):
+            viz.put( *preview )
+
+    trace.stats.dump( 'server' )
+    if( batcher is not None ):
+        batcher.dump()
+    print( 'Closing socket' )
+    socket.close()
+    context.destroy()
+    viz.close()
+    print( 'bye' )
 
-            try:
-                img0 = img.copy()
-
-                if( verbose ):
-                    print(json.dumps(data, indent=2))
-
-                if( imshow or imfile ):
-                    c = (255,0,0) #BGR, blur
-                    bc = (192,192,192)
-                    try:
-                        draw_rect( img, data['rect'], c )
-                    except:
-                        pass
-
-                    try:
-                        text = data['code']
-                        r = data['rect']
-                        pos = (r.left+r.width/2, r.top+r.height)
-                        draw_text( img, text, pos, c, bc )
-                    except:
-                        pass
-
-                    try:
-                        if( data['pred'] < 0.5 ):
-                            c = (255,255,  0) #BGR cyan for dog
-                        else:
-                            c = (255,  0,255) #BGR magenta for cat
-                        bc = (64,64,64)
-                    except:
-                        c = (255,0,0) #BGR blue
-                        bc = (192,192,192)
-
-                    try:
-                        draw_rect( img, data['roi_rect'], c )
-                    except:
-                        pass
-
-                    try:
-                        text = vs_str[0] if data['pred'] < 0.5 else vs_str[1]
-                        text = text + ':{:5.3f}'.format(data['pred'])
-                        r = data['roi_rect']
-                        pos = (r.left+r.width/2, r.top+r.height)
-                        draw_text( img, text, pos, c, bc )
-
-                    except:
-                        pass
-
-                if( imshow ):
-                    cv2.imshow('Hit space key to save image.',img)
-                    #cv2.waitKey(1)
-                    key = cv2.waitKey(1) & 0xff
-                    if( key == ord(' ') ):
-                        if( os.path.exists('./capture') == False):
-                            os.mkdir('./capture')
-                        cv2.imwrite('./capture/'+datetime.datetime.now().strftime("%Y%m%d-%H%M%S")+'.jpg',img0)
-
-
-                if( imfile is not None ):
-                    cv2.imwrite(imfile,img)
+WORKER_READY = b'READY'
+
+def worker_start( backend, factory, factory_args=(), verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], zmq_mode=None, jpeg_backend=None ):
+    '''
+    Inference worker behind server_broker.
+    func = factory(*factory_args) is built once in this process.
+    '''
+    try:
+        func = factory( *factory_args )
+        decoder = JpegDecoder( jpeg_backend )
+
+        context = zmq.Context()
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 10)
+        socket.connect(backend)
+        viz = Visualizer( verbose, imshow, imfile, vs_str )
+        socket.send(WORKER_READY)
+
+        while( True ):
+            frames = socket.recv_multipart(copy=False)
+            envelope, body = split_envelope( frames )
+
+            trace.begin()
+            kind, meta, arrays = unpack_request( body, zmq_mode, decoder )
+            trace.mark('decode')
+            data = handle_request( kind, meta, arrays, func, zmq_mode )
+            socket.send_multipart( envelope + [encode_reply( data, meta )] )
+
+            if( kind is not None and not is_dropped( data ) ):
+                print( 'send at', datetime.datetime.now() )
+                img = preview_image( kind, meta, arrays )
+                if( img is not None ):
+                    viz.put( img, preview_result( kind, data ) )
+    except KeyboardInterrupt:
+        pass
+
+    trace.stats.dump( 'worker {}'.format(os.getpid()) )
+    viz.close()
+
+def server_broker( port=5556, factory=None, factory_args=(), workers=2, verbose=False, imshow=False, imfile=None, vs_str=['dog', 'cat'], zmq_mode = None, jpeg_backend=None, conflate=False, ipc=None ):
+    '''
+    Load balancing broker in front of `workers` worker processes.
+    Clients (REQ or DEALER) connect to the ROUTER frontend as with server_start.
+    Each request goes to an idle worker and the reply is routed back to its
+    client, so one slow frame never holds up the others.
+    Only the first worker draws the preview and writes imfile.
+    conflate: as with server_start, only the newest waiting request of a
+    client is handed to a worker.
+    ipc: extra frontend endpoint, as with server_start.
+    '''
+    print( 'host: ', ip() )
+    print( 'port: ', port )
 
-            except:
-                error_message = traceback.format_exc()
-                print( '***** ERROR in server *****', file=sys.stderr )
-                print( error_message, file=sys.stderr )
-                print( '*************************', file=sys.stderr )
+    context = zmq.Context()
+    frontend = context.socket(zmq.ROUTER)
+    frontend.setsockopt(zmq.LINGER, 10)
+    for endpoint in endpoints( port, zmq_mode, ipc ):
+        frontend.bind(endpoint)
+
+    backend = context.socket(zmq.ROUTER)
+    backend.setsockopt(zmq.LINGER, 10)
+    backend_port = backend.bind_to_random_port('tcp://127.0.0.1')
+    backend_addr = 'tcp://127.0.0.1:{}'.format(backend_port)
+
+    mp = multiprocessing.get_context('spawn')
+    procs = []
+    for i in range(workers):
+        args = ( backend_addr, factory, factory_args, verbose,
+                 imshow and i == 0, imfile if i == 0 else None, vs_str, zmq_mode, jpeg_backend )
+        p = mp.Process( target=worker_start, args=args, daemon=True )
+        p.start()
+        procs.append( p )
+    print("Server startup. workers:", workers)
+
+    poll_workers = zmq.Poller()
+    poll_workers.register(backend, zmq.POLLIN)
+    poll_both = zmq.Poller()
+    poll_both.register(backend, zmq.POLLIN)
+    poll_both.register(frontend, zmq.POLLIN)
+
+    idle = collections.deque()
+    pending = collections.OrderedDict()
+    while( True ):
+        try:
+            # accept requests only while some worker is idle,
+            # or all the time to conflate them
+            socks = dict( (poll_both if idle or conflate else poll_workers).poll() )
+        except KeyboardInterrupt:
+            print()
+            break
+
+        if( socks.get(backend) == zmq.POLLIN ):
+            # [worker, b'', client envelope..., b'', reply] or [worker, b'', READY]
+            frames = backend.recv_multipart(copy=False)
+            idle.append( frames[0].bytes )
+            if( frames[2].bytes != WORKER_READY ):
+                frontend.send_multipart( frames[2:], copy=False )
+
+        if( conflate ):
+            conflate_requests( frontend, pending )
+            while( idle and pending ):
+                backend.send_multipart( [idle.popleft(), b''] + pending.popitem( last=False )[1], copy=False )
+
+        elif( socks.get(frontend) == zmq.POLLIN ):
+            frames = frontend.recv_multipart(copy=False)
+            backend.send_multipart( [idle.popleft(), b''] + frames, copy=False )
 
     print( 'Closing socket' )
-    socket.close()
+    frontend.close()
+    backend.close()
     context.destroy()
-    if( imshow ):
-        cv2.destroyAllWindows()
+    for p in procs:
+        p.join(1)
+        if( p.is_alive() ):
+            p.terminate()
     print( 'bye' )
 
 if( __name__ == '__main__' ):
@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import itertools
+import multiprocessing
+import yaml
+import cv2
+import zmq
+import numpy as np
+
+from util.client import Client, AsyncClient
+from util.server import unpack_request, handle_request, encode_reply
+from util.jpeg import JpegDecoder
+from util.protocol import FRAMES_PER_ARRAY
+
+# zmq_mode x transport x image size x JPEG quality, against a server stand-in
+# that decodes every frame and answers at once. Results go to a JSON file;
+# with a baseline file, a slower p50 or more bytes than `tolerance` allows
+# fail the run (exit code 1).
+
+
+def standin(img):
+    # process CPU time so far, the client takes per-frame deltas
+    return {'pred': 0, 'cpu': time.process_time()}
+
+
+def serve(endpoint, zmq_mode, jpeg_backend=None):
+    sys.stdout = open(os.devnull, 'w')
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.bind(endpoint)
+    decoder = JpegDecoder(jpeg_backend)
+    try:
+        while True:
+            frames = socket.recv_multipart(copy=False)
+            kind, meta, arrays = unpack_request(frames, zmq_mode, decoder)
+            data = handle_request(kind, meta, arrays, standin, zmq_mode)
+            socket.send(encode_reply(data, meta))
+    except KeyboardInterrupt:
+        pass
+
+
+class Recorder:
+    # stands in for util.adaptive.AdaptiveQuality: fixed quality, keeps what the client measured
+    def __init__(self, quality):
+        self.quality = quality
+        self.level = 0
+        self.samples = []
+
+    def update(self, encode_time, nbytes, rtt, server_time=0.0, rect=None, level=None):
+        self.samples.append((encode_time, nbytes, rtt))
+
+
+def test_image(size, file=None):
+    if file is not None:
+        return cv2.resize(cv2.imread(file), size, interpolation=cv2.INTER_AREA)
+    # smooth gradients with some texture, so JPEG sizes are not unrealistically small
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w]
+    img = np.stack([x * 255 // w, y * 255 // h, (x + y) % 256], axis=2).astype(np.uint8)
+    noise = np.random.default_rng(0).integers(0, 48, img.shape, dtype=np.uint8)
+    return cv2.GaussianBlur(cv2.add(img, noise), (3, 3), 0)
+
+
+def endpoint(transport, port, tmpdir):
+    if transport == 'ipc':
+        return 'ipc://' + os.path.join(tmpdir, 'benchmark_{}'.format(port))
+    return 'tcp://127.0.0.1:{}'.format(port)
+
+
+def run(img, zmq_mode, ep, quality, frames, warmup, window, jpeg_backend):
+    ctx = multiprocessing.get_context('spawn')
+    server = ctx.Process(target=serve, args=(ep, zmq_mode, jpeg_backend), daemon=True)
+    server.start()
+    try:
+        recorder = Recorder(quality)
+        if window > 0:
+            cl = AsyncClient(ep, timeout=5000, zmq_mode=zmq_mode, window=window, controller=recorder, heartbeat=0)
+        else:
+            cl = Client(ep, timeout=5000, zmq_mode=zmq_mode, controller=recorder, heartbeat=0)
+
+        for i in range(warmup):
+            data = cl.send_img(img)
+        recorder.samples.clear()
+        server_cpu0 = data['cpu']
+
+        cpu0 = time.process_time()
+        t0 = time.time()
+        if window > 0:
+            sent = 0
+            while sent < frames or cl.in_flight:
+                if sent < frames and cl.submit(img) is not None:
+                    sent += 1
+                d = cl.poll(0 if sent < frames and cl.ready() else cl.timeout)
+                if d is not None:
+                    data = d
+        else:
+            for i in range(frames):
+                data = cl.send_img(img)
+        elapsed = time.time() - t0
+        cpu = time.process_time() - cpu0
+        lost = cl.lost_frames
+        cl.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    done = [s for s in recorder.samples if s[2] is not None]
+    rtt = np.array([s[2] for s in done])
+    return {
+        'frames': len(done),
+        'lost': lost,
+        'p50_ms': float(np.percentile(rtt, 50) * 1000),
+        'p99_ms': float(np.percentile(rtt, 99) * 1000),
+        'fps': len(done) / elapsed,
+        'bytes': float(np.mean([s[1] for s in done])),
+        'encode_ms': float(np.mean([s[0] for s in done]) * 1000),
+        'client_cpu_ms': cpu / frames * 1000,
+        'server_cpu_ms': (data['cpu'] - server_cpu0) / frames * 1000,
+    }
+
+
+def key(r):
+    return '{zmq_mode}/{transport}/{width}x{height}/q{quality}/w{window}'.format(**r)
+
+
+def compare(results, baseline_file, tolerance):
+    # -> regressions against an earlier results file
+    with open(baseline_file) as f:
+        baseline = {key(r): r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        b = baseline.get(key(r))
+        if b is None:
+            continue
+        for metric in ['p50_ms', 'bytes']:
+            if r[metric] > b[metric] * (1 + tolerance):
+                regressions.append('{} {}: {:.2f} -> {:.2f}'.format(key(r), metric, b[metric], r[metric]))
+    return regressions
+
+
+def main():
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    bench = params['benchmark']
+
+    results = []
+    tmpdir = tempfile.mkdtemp()
+    port = bench.get('port', 5600)
+
+    print('{:28s} {:>8s} {:>8s} {:>8s} {:>9s} {:>9s} {:>9s}'.format(
+        'zmq_mode/transport/size/q/w', 'p50[ms]', 'p99[ms]', 'fps', 'bytes', 'cpu_c[ms]', 'cpu_s[ms]'))
+    for zmq_mode, transport, size, window in itertools.product(
+            bench['zmq_modes'], bench['transports'], bench['sizes'], bench['windows']):
+        if not zmq_mode in FRAMES_PER_ARRAY:
+            continue
+        if zmq_mode == 5 and transport != 'ipc':
+            # servers take shared memory frames on their ipc endpoint only
+            continue
+        img = test_image(tuple(size), bench.get('image'))
+        # quality only matters to the JPEG mode
+        for quality in (bench['qualities'] if zmq_mode == 3 else [None]):
+            port += 1
+            r = dict(zmq_mode=zmq_mode, transport=transport, width=size[0], height=size[1],
+                     quality=quality, window=window)
+            r.update(run(img, zmq_mode, endpoint(transport, port, tmpdir), quality or 75,
+                         bench['frames'], bench['warmup'], window, params['server'].get('jpeg_backend')))
+            results.append(r)
+            print('{:28s} {:8.2f} {:8.2f} {:8.1f} {:9.0f} {:9.2f} {:9.2f}'.format(
+                key(r), r['p50_ms'], r['p99_ms'], r['fps'], r['bytes'], r['client_cpu_ms'], r['server_cpu_ms']))
+
+    out = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'zmq': zmq.zmq_version(),
+        'results': results,
+    }
+    with open(bench['output'], 'w') as f:
+        json.dump(out, f, indent=2)
+    print('saved', bench['output'])
+
+    if bench.get('baseline'):
+        regressions = compare(results, bench['baseline'], bench['tolerance'])
+        for r in regressions:
+            print('REGRESSION', r)
+        if regressions:
+            sys.exit(1)
+
+
+# python scripts_rpi4/benchmark.py
+if (__name__ == '__main__'):
+    main()
@@ -6,12 +6,12 @@ import yaml
 import pickle
 import datetime
 
-from img2feat import CNN
 
 import util.preprocessing as pre
 from util.qrcode import detect_roi
 from util.progressbar import print_progress
 from evaluation import evaluation
+from weights import load_backbone, feature_tap, model_filename
 
 if (__name__ == '__main__'):
     # load params
@@ -21,16 +21,17 @@ if (__name__ == '__main__'):
     eval_params = params['evaluation']
     eval_params['network'] = params['network']
     eval_params['name'] = params['name']
+    eval_params['img_size'] = params.get('img_size', 224)
 
     # load model
-    filename = params['name'] + '_' + params['network'] + '.pkl'
-    model = pickle.load(open('model/' + filename, 'rb'))
+    model = pickle.load(open(model_filename(params, params['network']), 'rb'))
     if model is None:
         print('couldnt load model')
         exit()
 
     # setup CNN
-    net = CNN(eval_params['network'])
+    net = load_backbone(eval_params['network'], params['weights']['directory'], params.get('img_size', 224),
+                        feature_tap(params, params['network']))
 
     # setup camera
     cap = cv2.VideoCapture(0)
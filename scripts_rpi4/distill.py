@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+import os
+import glob
+import json
+import pickle
+import cv2
+import yaml
+import numpy as np
+import torch
+from torch import nn
+
+import util.preprocessing as pre
+from util.head import fold_linear, head_proba
+from util.progressbar import print_progress
+from train import augment, augmentation
+from evaluation import evaluation_from_param
+from quantize import load_cnn, latency
+from weights import load_backbone, variant, model_filename
+from export import MEAN_BGR, STD_BGR, ExportedModel, student_filename
+
+# Distillation of the teacher (network + head) into a compact student
+#
+# The student is an img2feat backbone (distill.student, ImageNet weights) with
+# a linear layer, fine-tuned on CPU on the data/train crops and their
+# augmentations. Its targets are the probabilities of the teacher head
+# (util.head.head_proba), computed once and cached in
+# model/<name>_<teacher>_teacher.npz, mixed with the labels of the file
+# names (distill.hard_weight). The student is saved as a graph like export.py
+# does (uint8 BGR images -> class probabilities) and served as network or
+# cascade tier "student".
+
+
+class Student(nn.Module):
+    def __init__(self, backbone, dim_feature):
+        super().__init__()
+        self.backbone = backbone
+        self.register_buffer('mean', torch.tensor(MEAN_BGR).view(1, 1, 1, 3))
+        self.register_buffer('std', torch.tensor(STD_BGR).view(1, 1, 1, 3))
+        self.linear = nn.Linear(dim_feature, 1)
+
+    def logits(self, imgs):
+        # imgs: (N, H, W, 3) uint8 BGR, normalised as export.Graph does
+        x = (imgs.float() / 255 - self.mean) / self.std
+        x = x.flip(3).permute(0, 3, 1, 2).contiguous()
+        return self.linear(self.backbone(x).flatten(1))[:, 0]
+
+    def forward(self, imgs):
+        p = torch.sigmoid(self.logits(imgs))
+        return torch.stack([1 - p, p], 1)
+
+
+def train_images(params):
+    # data/train crops preprocessed as for training -> images, labels, files
+    imgs, labels, files = [], [], []
+    for file in sorted(glob.glob('{}/*'.format(params['directory']))):
+        img = cv2.imread(file)
+        y = pre.code2label(os.path.basename(file))
+        if img is None or y is None:
+            continue
+        img = pre.equalization(img, params['equalization'])
+        imgs.append(pre.make_squared(img, params['make_squared'], params.get('img_size', 224)))
+        labels.append(y)
+        files.append(os.path.basename(file))
+    return imgs, np.array(labels), files
+
+
+def teacher_outputs(params, teacher, imgs, files):
+    # -> (N, 8) P(classes[1]) of the teacher for every augmentation, classes;
+    # cached until the files or the teacher head change
+    pkl = model_filename(params, teacher)
+    cache = 'model/{}_{}_teacher.npz'.format(params['name'], variant(teacher, params))
+    if os.path.exists(cache):
+        c = np.load(cache)
+        if list(c['files']) == files and float(c['mtime']) == os.path.getmtime(pkl):
+            return c['soft'], c['classes']
+
+    net = load_cnn(teacher, params)
+    head = fold_linear(pickle.load(open(pkl, 'rb')))
+    soft = np.zeros((len(imgs), 8), dtype=np.float32)
+    for i, img in enumerate(imgs):
+        soft[i] = head_proba(head, net(augment(img)))[:, 1]
+        print_progress(i + 1, len(imgs))
+    print("\n")
+    np.savez(cache, files=np.array(files), soft=soft, classes=head['classes'], mtime=os.path.getmtime(pkl))
+    return soft, head['classes']
+
+
+def distill(student, imgs, soft, hard, dparams):
+    # imgs: student-sized crops; soft, hard: (N, 8) targets per augmentation
+    optimizer = torch.optim.Adam([p for p in student.parameters() if p.requires_grad], lr=dparams['lr'])
+    samples = [(i, k) for i in range(len(imgs)) for k in range(8)]
+    rng = np.random.default_rng(0)
+    w = dparams['hard_weight']
+    bce = nn.functional.binary_cross_entropy_with_logits
+    for epoch in range(dparams['epochs']):
+        student.train()
+        order = rng.permutation(len(samples))
+        total, agree = 0.0, 0
+        for b in range(0, len(order), dparams['batch_size']):
+            batch = [samples[j] for j in order[b:b + dparams['batch_size']]]
+            x = torch.from_numpy(np.stack([augmentation(imgs[i], k) for i, k in batch]))
+            t_soft = torch.from_numpy(np.array([soft[i, k] for i, k in batch], dtype=np.float32))
+            t_hard = torch.from_numpy(np.array([hard[i, k] for i, k in batch], dtype=np.float32))
+
+            logits = student.logits(x)
+            loss = (1 - w) * bce(logits, t_soft) + w * bce(logits, t_hard)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            total += float(loss) * len(batch)
+            agree += int(((logits > 0) == (t_soft > 0.5)).sum())
+        print('epoch {}: loss {:.4f}, agreement with the teacher {:.1f} %'.format(
+            epoch, total / len(samples), agree / len(samples) * 100))
+    return student.eval()
+
+
+def save_student(student, filename, meta):
+    w, h = meta['img_size']
+    with torch.no_grad():
+        example = torch.zeros((1, h, w, 3), dtype=torch.uint8)
+        torch.jit.save(torch.jit.freeze(torch.jit.trace(student, example)), filename)
+    with open(os.path.splitext(filename)[0] + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return filename
+
+
+class GraphModel:
+    # exported graph with the (net, model) interface evaluation_from_param uses
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __call__(self, imgs):
+        return imgs
+
+    def predict(self, imgs):
+        return self.graph(imgs)[0]
+
+
+if (__name__ == '__main__'):
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    dparams = params['distill']
+    teacher = dparams['teacher']
+    size = (dparams['img_size'], dparams['img_size'])
+
+    print("--- teacher {} ---".format(teacher))
+    train_params = dict(params['train'], img_size=params.get('img_size', 224))
+    imgs, labels, files = train_images(train_params)
+    soft, classes = teacher_outputs(params, teacher, imgs, files)
+    # augmentations keep the label
+    hard = np.repeat((labels == classes[1]).astype(np.float32)[:, np.newaxis], 8, axis=1)
+
+    print("--- student {} {}x{} ---".format(dparams['student'], *size))
+    net = load_backbone(dparams['student'], params['weights']['directory'], size)
+    backbone = net._CNN__network
+    for p in backbone.parameters():
+        p.requires_grad = True
+    student = distill(Student(backbone, net.dim_feature), [cv2.resize(img, size) for img in imgs], soft, hard, dparams)
+
+    filename = save_student(student, student_filename(params), {
+        'network': dparams['student'],
+        'teacher': variant(teacher, params),
+        'img_size': list(size),
+        'classes': classes.tolist(),
+        'calibrated': True,
+        'backend': None,
+    })
+    print('saved', filename)
+
+    # teacher / student on the evaluation sets
+    graph = GraphModel(ExportedModel(filename))
+    teacher_net = load_cnn(teacher, params)
+    teacher_model = pickle.load(open(model_filename(params, teacher), 'rb'))
+    base_params = dict(params['evaluation'], name=params['name'], img_size=params.get('img_size', 224),
+                       print_result=False)
+    results = []
+    for setting in params['evaluation_settings']:
+        eval_params = base_params.copy()
+        eval_params.update(params[setting])
+        print("--- evaluation {} ---".format(setting))
+        results.append((setting, evaluation_from_param(teacher_model, eval_params, teacher_net),
+                        evaluation_from_param(graph, eval_params, graph)))
+
+    img = imgs[0]
+    t_teacher = latency(teacher_net, img, dparams['latency_runs'])
+    t_student = latency(graph.graph, img, dparams['latency_runs'])
+    print("--- teacher / student accuracy [%] ---")
+    for setting, acc_teacher, acc_student in results:
+        print('{:20s} {:6.1f} {:6.1f} ({:+.1f})'.format(
+            setting, acc_teacher * 100, acc_student * 100, (acc_student - acc_teacher) * 100))
+    print('latency [ms]: teacher backbone {:.1f}, student {:.1f} ({:.1f}x)'.format(
+        t_teacher, t_student, t_teacher / t_student))
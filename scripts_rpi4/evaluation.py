@@ -5,18 +5,20 @@ import cv2
 import yaml
 import pickle
 
-from img2feat import CNN
-
 import util.preprocessing as pre
 from util.qrcode import detect_roi
 from util.progressbar import print_progress
+from util import trace
 
-IMG_SIZE = (224, 224)
 PRINT_RESULT = True
 
 
-def evaluation_from_param(model,  params):
-    net = CNN(params['network'], img_size=IMG_SIZE)
+def evaluation_from_param(model,  params, net=None):
+    if net is None:
+        # img2feat (torch, torchvision) only when no backbone is passed in
+        from weights import load_backbone, feature_tap
+        net = load_backbone(params['network'], img_size=params.get('img_size', 224),
+                            feature=feature_tap(params, params['network']))
 
     data_num = 0
     correct_num = 0
@@ -45,16 +47,54 @@ def evaluation_from_param(model,  params):
         if not params['print_result']:
             print_progress(i + 1, len(files))
     print(f'\naccuracy:{correct_num / data_num * 100} %')
+    return correct_num / data_num
 
 def evaluation(model, net, img, code, params):
+    return evaluation_batch(model, net, [img], [code], params)[0]
+
+
+def evaluation_batch(model, net, imgs, codes, params):
+    # one net() forward pass and one model.predict() for all images,
+    # None for the images without a QR code
+    xs, index = preprocess_batch(imgs, codes, params)
+
+    ys = [None] * len(imgs)
+    if not xs:
+        return ys
+
+    x = net(xs)
+    trace.mark('forward')
+    y = model.predict(x)
+    trace.mark('predict')
+
+    for j, i in enumerate(index):
+        ys[i] = y[j:j + 1]
+    return ys
+
+
+def preprocess_batch(imgs, codes, params):
+    # -> preprocessed images, and the index in imgs of each
+    xs = []
+    index = []
+    for i, (img, code) in enumerate(zip(imgs, codes)):
+        img = preprocess(img, code, params)
+        if img is not None:
+            xs.append(img)
+            index.append(i)
+    trace.mark('preprocess')
+    return xs, index
+
+
+def preprocess(img, code, params):
     if img is None:
-        return
+        return None
     label = None
     if params['have_qr']:
         (code, rect), (img, roi_rect) = detect_roi(img)
         if code is None or img is None:
             return None
         label = pre.code2label(code)
+        trace.mark('detect')
     else:
         label = pre.code2label(code)
 
@@ -64,17 +104,14 @@ def evaluation(model, net, img, code, params):
     # 前処理
     img = pre.equalization(img, params['equalization'])
     if not params['have_qr']:
-        img = pre.make_squared(img, params['make_squared'])
+        img = pre.make_squared(img, params['make_squared'], params.get('img_size', 224))
 
     # プレビュー
     if params['preview']:
         cv2.imshow('evaluated iage', img)
         cv2.waitKey(10)
 
-    x = net([img])
-    y = model.predict(x)
-
-    return y
+    return img
 
 
 if (__name__ == '__main__'):
@@ -83,9 +120,10 @@ if (__name__ == '__main__'):
     with open('config/default.yaml') as f:
         params = yaml.safe_load(f)
 
+    from weights import load_backbone, feature_tap, model_filename
+
     # load model
-    filename = params['name'] + '_' + params['network'] + '.pkl'
-    model = pickle.load(open('model/' + filename, 'rb'))
+    model = pickle.load(open(model_filename(params, params['network']), 'rb'))
 
     if model is None:
         print('couldnt load model')
@@ -94,12 +132,17 @@ if (__name__ == '__main__'):
     base_params = params['evaluation']
     base_params['network'] = params['network']
     base_params['name'] = params['name']
+    base_params['img_size'] = params.get('img_size', 224)
 
     PRINT_RESULT = False
 
+    # one backbone for all settings
+    net = load_backbone(params['network'], params['weights']['directory'], params.get('img_size', 224),
+                        feature_tap(params, params['network']))
+
     for setting in params['evaluation_settings']:
         eval_params = base_params.copy()
         eval_params.update(params[setting])
         # evaluation
         print("--- evaluation {} ---".format(setting))
-        evaluation_from_param(model, eval_params)
+        evaluation_from_param(model, eval_params, net)
@@ -0,0 +1,210 @@
+#! /usr/bin/env python3
+import os
+import sys
+import glob
+import json
+import pickle
+import cv2
+import yaml
+import numpy as np
+import torch
+from torch import nn
+
+from quantize import load_cnn, calibration_images
+from evaluation import preprocess_batch
+from weights import variant, model_filename
+from util.head import fold_linear, head_proba, predict_confidence, save_head, load_head
+
+# One inference graph per backbone: BGR uint8 images -> class probabilities
+#
+# The graph takes the images resized to the backbone input size, does the
+# normalisation of img2feat.CNN.imgs2tensor, runs the backbone and the head
+# of train.train_model with the scaler and the SVM folded into one linear
+# layer (util/head.py). It is saved as TorchScript, model/<name>_<network>.ts,
+# and as ONNX, model/<name>_<network>.onnx, for other runtimes.
+#
+# The folded head alone is saved as model/<name>_<network>.npz (runtime
+# numpy: img2feat + a numpy head, no sklearn at serving time); its labels are
+# checked to be identical to the sklearn ones on every evaluation setting.
+#
+# runtime: torchscript / onnx / numpy in config/default.yaml makes the server
+# load them instead of img2feat + the pickled head.
+
+# imgs2tensor: (BGR/255 - mean) / std per BGR channel, then B and R swapped
+MEAN_BGR = [0.485, 0.456, 0.406]
+STD_BGR = [0.229, 0.224, 0.225]
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def exported_filename(params, network, runtime):
+    ext = {'torchscript': '.ts', 'onnx': '.onnx', 'numpy': '.npz'}[runtime]
+    # the head alone does not depend on the backbone precision
+    int8 = '_int8' if params.get('precision', 'float32') == 'int8' and runtime != 'numpy' else ''
+    return 'model/' + params['name'] + '_' + variant(network, params) + int8 + ext
+
+
+def student_filename(params):
+    # student distilled by distill.py, served as network / cascade tier "student"
+    dparams = params['distill']
+    return 'model/{}_student_{}_{}.ts'.format(params['name'], dparams['student'], dparams['img_size'])
+
+
+class Graph(nn.Module):
+    def __init__(self, backbone, head):
+        super().__init__()
+        self.backbone = backbone
+        self.register_buffer('mean', torch.tensor(MEAN_BGR).view(1, 1, 1, 3))
+        self.register_buffer('std', torch.tensor(STD_BGR).view(1, 1, 1, 3))
+
+        weight = torch.from_numpy(head['weight'].astype(np.float32))
+        self.linear = nn.Linear(weight.shape[1], weight.shape[0])
+        self.linear.weight.data.copy_(weight)
+        self.linear.bias.data.copy_(torch.from_numpy(head['bias'].astype(np.float32)))
+        self.calibrated = head['a'] is not None
+        if self.calibrated:
+            self.register_buffer('a', torch.from_numpy(head['a'].astype(np.float32)))
+            self.register_buffer('b', torch.from_numpy(head['b'].astype(np.float32)))
+
+    def forward(self, imgs):
+        # imgs: (N, H, W, 3) uint8 BGR -> (N, 2) probabilities
+        x = (imgs.float() / 255 - self.mean) / self.std
+        x = x.flip(3).permute(0, 3, 1, 2).contiguous()
+        d = self.linear(self.backbone(x).flatten(1))
+        if self.calibrated:
+            p = torch.sigmoid(-(self.a * d + self.b)).mean(1)
+        else:
+            p = torch.sigmoid(d[:, 0])
+        return torch.stack([1 - p, p], 1)
+
+
+class ExportedModel:
+    '''
+    A graph saved by export(): preprocessed images -> (labels, confidences),
+    as net() + util.head.predict_confidence() compute them.
+    '''
+
+    def __init__(self, filename):
+        meta_file = os.path.splitext(filename)[0] + '.json'
+        with open(meta_file) as f:
+            meta = json.load(f)
+        self.img_size = tuple(meta['img_size'])
+        self.classes = np.array(meta['classes'])
+        if meta.get('backend'):
+            torch.backends.quantized.engine = meta['backend']
+
+        if filename.endswith('.onnx'):
+            if onnxruntime is None:
+                raise ImportError('onnxruntime is not installed.')
+            self.session = onnxruntime.InferenceSession(filename, providers=['CPUExecutionProvider'])
+            self.graph = None
+        else:
+            self.session = None
+            self.graph = torch.jit.load(filename)
+
+    def __call__(self, imgs):
+        x = np.stack([cv2.resize(img, self.img_size) for img in imgs])
+        if self.graph is not None:
+            with torch.no_grad():
+                proba = self.graph(torch.from_numpy(x)).numpy()
+        else:
+            proba = self.session.run(None, {'imgs': x})[0]
+        k = proba.argmax(axis=1)
+        return self.classes[k], proba[np.arange(len(k)), k]
+
+
+def export(net, model, network, params, runtimes):
+    head = fold_linear(model)
+    # the int8 backbone of quantize.py is a TorchScript module already
+    graph = Graph(net._CNN__network, head).eval()
+    w, h = net.img_size
+    example = torch.zeros((1, h, w, 3), dtype=torch.uint8)
+
+    meta = {
+        'network': network,
+        'img_size': [w, h],
+        'classes': head['classes'].tolist(),
+        'calibrated': head['a'] is not None,
+        'backend': torch.backends.quantized.engine if params.get('precision') == 'int8' else None,
+    }
+    files = []
+    for runtime in runtimes:
+        filename = exported_filename(params, network, runtime)
+        if runtime == 'numpy':
+            continue
+        if runtime == 'torchscript':
+            with torch.no_grad():
+                torch.jit.save(torch.jit.freeze(torch.jit.trace(graph, example)), filename)
+        elif params.get('precision') == 'int8':
+            print('onnx: skipped, the int8 backbone can only be exported as TorchScript')
+            continue
+        else:
+            torch.onnx.export(graph, example, filename, input_names=['imgs'], output_names=['proba'],
+                              dynamic_axes={'imgs': {0: 'batch'}, 'proba': {0: 'batch'}},
+                              opset_version=params['export'].get('opset', 13))
+        with open(os.path.splitext(filename)[0] + '.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        files.append(filename)
+    return files
+
+
+def check_head(net, model, head, params):
+    # numpy head against sklearn on the evaluation sets -> all labels equal
+    base_params = dict(params['evaluation'], img_size=params.get('img_size', 224))
+    same = True
+    for setting in params['evaluation_settings']:
+        eval_params = base_params.copy()
+        eval_params.update(params[setting])
+        files = sorted(glob.glob('{}/*'.format(eval_params['directory'])))
+        xs, index = preprocess_batch([cv2.imread(file) for file in files],
+                                     [os.path.basename(file) for file in files], eval_params)
+        if not xs:
+            continue
+        x = net(xs)
+        y, y_ref = head.predict(x), model.predict(x)
+        c, c_ref = predict_confidence(head, x)[1], predict_confidence(model, x)[1]
+        print('{:20s} labels {}/{} equal, max |confidence diff| {:.2e}'.format(
+            setting, int((y == y_ref).sum()), len(y), np.abs(c - c_ref).max()))
+        same = same and bool((y == y_ref).all())
+    return same
+
+
+if (__name__ == '__main__'):
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    eparams = params['export']
+
+    # the distilled student is saved as a graph by distill.py already
+    networks = [n for n in (params['server'].get('cascade') or []) + [params['network']] if n != 'student']
+    imgs = calibration_images(dict(params['train'], img_size=params.get('img_size', 224)), eparams['check_images'])
+    for network in networks:
+        print("--- export {} ---".format(network))
+        net = load_cnn(network, params)
+        model = pickle.load(open(model_filename(params, network), 'rb'))
+
+        # reference: features + sklearn head, and its numpy fold
+        x = net(imgs)
+        labels, confidences = predict_confidence(model, x)
+        folded = head_proba(fold_linear(model), x).max(axis=1)
+        print('folded head: max |confidence diff| {:.2e}'.format(np.abs(folded - confidences).max()))
+
+        if 'numpy' in eparams['runtimes']:
+            filename = save_head(exported_filename(params, network, 'numpy'), fold_linear(model),
+                                 {'network': network, 'dim_feature': net.dim_feature})
+            print('saved', filename)
+            if not check_head(net, model, load_head(filename), params):
+                print('***** ERROR: the numpy head does not reproduce the sklearn labels *****', file=sys.stderr)
+                sys.exit(1)
+
+        for filename in export(net, model, network, params, eparams['runtimes']):
+            if filename.endswith('.onnx') and onnxruntime is None:
+                print('saved', filename, '(not checked, onnxruntime is not installed)')
+                continue
+            y, c = ExportedModel(filename)(imgs)
+            print('saved {}: labels {}/{} equal, max |confidence diff| {:.2e}'.format(
+                filename, int((y == labels).sum()), len(labels), np.abs(c - confidences).max()))
@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+import os
+import json
+import glob
+import time
+import copy
+import pickle
+import platform
+import cv2
+import yaml
+import numpy as np
+import torch
+
+import util.preprocessing as pre
+from evaluation import evaluation_from_param
+from weights import DIRECTORY, load_backbone, feature_tap, variant, model_filename
+
+# Post-training static quantization of the backbone (INT8, CPU)
+#
+# The float network of img2feat.CNN is quantized with FX graph mode: observers
+# are calibrated on preprocessed data/train images, then the traced INT8 graph
+# is saved as model/<name>_<network>_int8.pt. The head (model/*.pkl) is kept;
+# the script checks its accuracy on the INT8 features against the float ones
+# for every evaluation setting and compares the latency of both backbones.
+#
+# precision: int8 in config/default.yaml makes the server load it.
+
+
+def quantized_filename(params, network):
+    return 'model/' + params['name'] + '_' + variant(network, params) + '_int8.pt'
+
+
+def default_backend():
+    # fbgemm on x86, qnnpack on ARM (Raspberry Pi)
+    machine = platform.machine().lower()
+    return 'qnnpack' if machine.startswith('arm') or machine.startswith('aarch') else 'fbgemm'
+
+
+def quantized_cnn(filename, batch_size=128):
+    '''
+    img2feat.CNN running a backbone saved by quantize(): same preprocessing,
+    batching and output, only the network is replaced.
+    '''
+    from img2feat import CNN
+    extra = {'meta.json': ''}
+    network = torch.jit.load(filename, _extra_files=extra)
+    meta = json.loads(extra['meta.json'])
+    torch.backends.quantized.engine = meta['backend']
+
+    # CNN.__init__ would build and load the float network first; its
+    # private attributes are set here instead
+    net = CNN.__new__(CNN)
+    net._CNN__gpu = False
+    net._CNN__img_size = tuple(meta['img_size'])
+    net._CNN__network = network
+    net._CNN__dim_feature = meta['dim_feature']
+    net.batch_size = batch_size
+    return net
+
+
+def load_cnn(network, params):
+    # backbone for `network` in the precision the config selects
+    if params.get('precision', 'float32') == 'int8':
+        return quantized_cnn(quantized_filename(params, network))
+    return load_backbone(network, params.get('weights', {}).get('directory', DIRECTORY),
+                         params.get('img_size', 224), feature_tap(params, network))
+
+
+def calibration_images(params, n):
+    # data/train images, preprocessed as for training
+    imgs = []
+    files = sorted(glob.glob('{}/*'.format(params['directory'])))
+    for file in files[:n]:
+        img = cv2.imread(file)
+        if img is None:
+            continue
+        img = pre.equalization(img, params['equalization'])
+        img = pre.make_squared(img, params['make_squared'], params.get('img_size', 224))
+        imgs.append(img)
+    return imgs
+
+
+def quantize(net, imgs, filename, network, backend=None, batch_size=16):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if backend is None:
+        backend = default_backend()
+    torch.backends.quantized.engine = backend
+
+    example = net.imgs2tensor(imgs[:1])
+    prepared = prepare_fx(copy.deepcopy(net._CNN__network).eval(),
+                          get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        for i in range(0, len(imgs), batch_size):
+            prepared(net.imgs2tensor(imgs[i:i + batch_size]))
+    quantized = convert_fx(prepared)
+
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(quantized, example))
+    meta = {
+        'network': network,
+        'backend': backend,
+        'img_size': list(net.img_size),
+        'dim_feature': net.dim_feature,
+        'calibration_images': len(imgs),
+    }
+    torch.jit.save(traced, filename, _extra_files={'meta.json': json.dumps(meta)})
+    return filename
+
+
+def latency(net, img, runs):
+    # [ms] p50 of one image, after one warm-up call
+    net([img])
+    times = []
+    for i in range(runs):
+        t0 = time.time()
+        net([img])
+        times.append(time.time() - t0)
+    return np.percentile(times, 50) * 1000
+
+
+if (__name__ == '__main__'):
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    qparams = params['quantize']
+    network = params['network']
+
+    # calibrate and save
+    print("--- quantize {} ---".format(network))
+    net = load_cnn(network, dict(params, precision='float32'))
+    imgs = calibration_images(dict(params['train'], img_size=params.get('img_size', 224)), qparams['calibration_images'])
+    filename = quantized_filename(params, network)
+    quantize(net, imgs, filename, network, qparams.get('backend'))
+    print('saved', filename, '({:.1f} MB)'.format(os.path.getsize(filename) / 1e6))
+    qnet = quantized_cnn(filename)
+
+    # latency
+    print("--- latency [ms] ---")
+    t_float = latency(net, imgs[0], qparams['latency_runs'])
+    t_int8 = latency(qnet, imgs[0], qparams['latency_runs'])
+    print('float32: {:.1f}  int8: {:.1f}  speedup: {:.2f}x'.format(t_float, t_int8, t_float / t_int8))
+
+    # accuracy with the float head
+    model = pickle.load(open(model_filename(params, network), 'rb'))
+
+    base_params = params['evaluation']
+    base_params['network'] = network
+    base_params['name'] = params['name']
+    base_params['img_size'] = params.get('img_size', 224)
+    base_params['print_result'] = False
+
+    results = []
+    for setting in params['evaluation_settings']:
+        eval_params = base_params.copy()
+        eval_params.update(params[setting])
+        print("--- evaluation {} ---".format(setting))
+        acc_float = evaluation_from_param(model, eval_params, net)
+        acc_int8 = evaluation_from_param(model, eval_params, qnet)
+        results.append((setting, acc_float, acc_int8))
+
+    print("--- float32 / int8 accuracy [%] ---")
+    for setting, acc_float, acc_int8 in results:
+        print('{:20s} {:6.1f} {:6.1f} ({:+.1f})'.format(
+            setting, acc_float * 100, acc_int8 * 100, (acc_int8 - acc_float) * 100))
@@ -1,60 +1,241 @@
 #! /usr/bin/env python3
 import sys
+import time
 import yaml
 import pickle
+import threading
+import traceback
 
 from pyzbar.locations import Rect
 import numpy as np
+import torch
 
-from img2feat import CNN
-from util.server import server_start
-from util.regression import load_model, predict
+from util.server import server_start, server_broker
+from util.head import predict_confidence, load_head
 from util.qrcode import detect_roi
-from evaluation import evaluation
+from util import trace
+from util.cache import DecisionCache
+from util.preprocessing import IMG_SIZE
+from evaluation import preprocess_batch
+from quantize import load_cnn
+from weights import model_filename
 
 
 class Classifier:
     def __init__(self, params, size_ratio=None, gap_ratio=None, th_area=None):
         self.params = params
+        # ROIs are squared to the backbone input size, as for training
+        self.preprocess_params = dict(params['evaluation'], img_size=params.get('img_size', 224))
 
         self.size_ratio = size_ratio
         self.gap_ratio = gap_ratio
         self.th_area = th_area
 
-        # setup network
-        self.net = CNN(params['network'])
+        # cascade: cheaper backbones first, `network` answers what they are not sure of
+        self.threshold = params['server'].get('cascade_threshold', 0.9)
+        self.tiers = []
+        runtime = params.get('runtime', 'sklearn')
+        if runtime != 'sklearn':
+            # onnxruntime etc. only when an exported runtime is configured
+            from export import ExportedModel, exported_filename
+        for network in (params['server'].get('cascade') or []) + [params['network']]:
+            if network == 'student':
+                # compact network distilled by distill.py, an exported graph as well
+                from export import ExportedModel, student_filename
+                self.tiers.append((network, ExportedModel(student_filename(params)), None))
+                continue
+            if runtime in ['torchscript', 'onnx']:
+                # backbone and head in one graph from export.py
+                self.tiers.append((network, ExportedModel(exported_filename(params, network, runtime)), None))
+                continue
 
-        # load model
-        filename = params['name'] + '_' + params['network'] + '.pkl'
-        self.model = pickle.load(open('model/' + filename, 'rb'))
+            # setup network (float32, or int8 from quantize.py)
+            net = load_cnn(network, params)
+
+            # load model (numpy: the folded head from export.py, sklearn is not imported)
+            if runtime == 'numpy':
+                model = load_head(exported_filename(params, network, runtime))
+            else:
+                model = pickle.load(open(model_filename(params, network), 'rb'))
+            self.tiers.append((network, net, model))
+        _, self.net, self.model = self.tiers[-1]
+
+        # decisions per QR code (None: off)
+        cache = params['server'].get('cache') or {}
+        self.cache = None
+        if cache.get('size', 0) > 0:
+            self.cache = DecisionCache(cache['size'], cache.get('ttl', 30),
+                                       cache.get('min_frames', 3), cache.get('threshold', 0.8))
+
+        # set by warmup(), reported in the hello reply
+        self.ready = False
+
+    def warmup(self, runs=3):
+        # dummy frames/ROIs through QR detection, preprocessing, every tier and
+        # its head, at batch size 1 and server.batch_size, so the first request
+        # does not pay for lazy initialisation and allocator growth
+        t0 = time.time()
+        rng = np.random.default_rng(0)
+        try:
+            detect_roi(np.zeros((720, 1280, 3), np.uint8))
+            for n in sorted({1, self.params['server'].get('batch_size', 1)}):
+                rois = [rng.integers(0, 256, (IMG_SIZE[1], IMG_SIZE[0], 3), dtype=np.uint8) for i in range(n)]
+                for i in range(runs):
+                    imgs, index = preprocess_batch(rois, ['warmup'] * n, self.preprocess_params)
+                    for network, net, model in self.tiers:
+                        self.predict(net, model, imgs or rois)
+            print('warm-up: {:.2f} s'.format(time.time() - t0))
+        except Exception:
+            # clients must not wait for a warm-up that never ends; the same
+            # error comes back in the replies to their requests
+            print('***** ERROR: warm-up failed *****', file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self.ready = True
 
     def __call__(self, img):
         (code, rect), (roi, roi_rect) = detect_roi(
             img, size_ratio=self.size_ratio, gap_ratio=self.gap_ratio, th_area=self.th_area)
-        res = evaluation(self.model, self.net, roi,
-                         code, self.params['evaluation'])
-        res = None if res is None else int(res[0])
+        trace.mark('detect')
+        return self.classify(code, rect, roi, roi_rect)
+
+    def classify_roi(self, roi, meta):
+        # the client already located the QR code and sent only the ROI
+        return self.classify(meta['code'], Rect(*meta['rect']), roi, Rect(*meta['roi_rect']))
+
+    def classify_frames(self, imgs):
+        # REQUEST_BATCH of frames: one forward pass for all of them
+        found = [detect_roi(img, size_ratio=self.size_ratio, gap_ratio=self.gap_ratio, th_area=self.th_area)
+                 for img in imgs]
+        trace.mark('detect')
+        return self.classify_many([(code, rect, roi, roi_rect) for (code, rect), (roi, roi_rect) in found])
+
+    def classify_rois(self, rois, metas):
+        # REQUEST_BATCH of ROIs located by the client
+        return self.classify_many([(meta['code'], Rect(*meta['rect']), roi, Rect(*meta['roi_rect']))
+                                   for roi, meta in zip(rois, metas)])
+
+    def classify(self, code, rect, roi, roi_rect):
+        return self.classify_many([(code, rect, roi, roi_rect)])[0]
+
+    def classify_many(self, items):
+        # items: [(code, rect, roi, roi_rect)]
+        # codes the cache has a confident decision for skip preprocessing and the CNN
+        results = [None] * len(items)
+        todo = []
+        for i, (code, rect, roi, roi_rect) in enumerate(items):
+            hit = None if self.cache is None or roi is None else self.cache.get(code)
+            if hit is not None:
+                results[i] = self.result(code, rect, roi_rect, *hit)
+            else:
+                todo.append(i)
+
+        if todo:
+            imgs, index = preprocess_batch([items[i][2] for i in todo],
+                                           [items[i][0] for i in todo], self.preprocess_params)
+            answers = dict(zip(index, self.cascade(imgs)))
+            for k, i in enumerate(todo):
+                code, rect, roi, roi_rect = items[i]
+                res, confidence, tier = answers.get(k, (None, None, None))
+                if self.cache is not None and res is not None:
+                    # aggregated over the frames of this code so far
+                    res, confidence = self.cache.add(code, res, confidence)
+                results[i] = self.result(code, rect, roi_rect, res, confidence, tier)
 
+        if self.cache is not None:
+            print(self.cache)
+        return results
+
+    def predict(self, net, model, imgs):
+        # -> labels, confidences of one tier
+        if model is None:
+            # exported graph
+            preds, confidences = net(imgs)
+            trace.mark('forward')
+            trace.mark('predict')
+            return preds, confidences
+        x = net(imgs)
+        trace.mark('forward')
+        preds, confidences = predict_confidence(model, x)
+        trace.mark('predict')
+        return preds, confidences
+
+    def cascade(self, imgs):
+        # -> (pred, confidence, tier) per preprocessed image; an image goes on
+        # to the next tier while its confidence is below the threshold
+        answers = [None] * len(imgs)
+        todo = list(range(len(imgs)))
+        for tier, (network, net, model) in enumerate(self.tiers):
+            if not todo:
+                break
+            preds, confidences = self.predict(net, model, [imgs[k] for k in todo])
+
+            last = tier == len(self.tiers) - 1
+            rest = []
+            for k, pred, confidence in zip(todo, preds, confidences):
+                if last or confidence >= self.threshold:
+                    answers[k] = (int(pred), float(confidence), tier)
+                else:
+                    rest.append(k)
+            print('tier {} {}: {} answered, {} passed on'.format(
+                tier, network, len(todo) - len(rest), len(rest)))
+            todo = rest
+        return answers
+
+    def result(self, code, rect, roi_rect, res, confidence=None, tier=None):
         data = {
             'code': code,
             'rect': rect,
             'roi_rect': roi_rect,
             'pred': res,
         }
+        if confidence is not None:
+            data['confidence'] = confidence
+        if tier is not None and len(self.tiers) > 1:
+            # index into cascade + [network]
+            data['tier'] = tier
         print(data)
         return data
 
 
+def build_classifier(params):
+    # runs once in every worker process
+    threads = params['server'].get('threads', 0)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    classifier = Classifier(params)
+
+    # warm up while the server already answers hellos (not ready yet)
+    runs = params['server'].get('warmup', 3)
+    if runs > 0:
+        threading.Thread(target=classifier.warmup, args=(runs,), daemon=True).start()
+    else:
+        classifier.ready = True
+    return classifier
+
+
 def main():
     # load params
     params = None
     with open('config/default.yaml') as f:
         params = yaml.safe_load(f)
 
+    workers = params['server'].get('workers', 0)
+    if workers > 0:
+        server_broker(params['server']['port'], build_classifier, (params,), workers=workers,
+                      verbose=False, imfile='server.jpg', imshow=params['server']['preview'],
+                      vs_str=['ant', 'bee'], zmq_mode=params['server']['zmq_mode'],
+                      jpeg_backend=params['server'].get('jpeg_backend'),
+                      conflate=params['server'].get('conflate', False), ipc=params['server'].get('ipc'))
+        return
+
     # steup network
-    classifier = Classifier(params)
+    classifier = build_classifier(params)
     server_start(params['server']['port'], classifier, verbose=False, imfile='server.jpg',
-                 imshow=params['server']['preview'], vs_str=['ant', 'bee'], zmq_mode=3)
+                 imshow=params['server']['preview'], vs_str=['ant', 'bee'], zmq_mode=params['server']['zmq_mode'],
+                 jpeg_backend=params['server'].get('jpeg_backend'), conflate=params['server'].get('conflate', False),
+                 ipc=params['server'].get('ipc'), batch_size=params['server'].get('batch_size', 1),
+                 batch_delay=params['server'].get('batch_delay', 5))
 
 
 # python server_classifier.py -v --port 5555
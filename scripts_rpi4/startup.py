@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+import collections
+import yaml
+import cv2
+import numpy as np
+
+from util.client import Client
+
+# Cold start of the car and the server
+#
+# Import time of every entry point (python -X importtime in a fresh
+# interpreter), summed per top-level package, and the time to the first
+# judgement of server_classifier.py: process start -> port bound
+# (imports + models loaded) -> ready (warm-up done) -> first frame classified.
+# Results go to a JSON file; with a baseline file, a slower first judgement
+# than `tolerance` allows fails the run (exit code 1), as benchmark.py does.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (directory, module) as the scripts are started on the car / the server
+ENTRY_POINTS = [
+    ('scripts_rpi3', 'main'),
+    ('scripts_rpi4', 'server_classifier'),
+    ('scripts_rpi4', 'train'),
+    ('scripts_rpi4', 'evaluation'),
+]
+
+
+def import_times(directory, module):
+    # -> total [ms], {package: self time [ms]}, error
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          cwd=os.path.join(ROOT, directory), stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    total = 0.0
+    packages = collections.Counter()
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = len(name) - len(name.lstrip())
+        name = name.strip()
+        packages[name.split('.')[0]] += int(self_us) / 1000
+        if depth == 1:
+            total += int(cumulative_us) / 1000
+    error = None
+    if proc.returncode != 0:
+        error = ([l for l in proc.stderr.splitlines() if not l.startswith('import time:')] or ['failed'])[-1]
+    return total, packages, error
+
+
+def wait_port(server, port, timeout):
+    # the server binds once its models are loaded; fail instead of waiting
+    # forever when it exits before that
+    t0 = time.time()
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError('server_classifier.py exited with {}'.format(server.returncode))
+        if time.time() - t0 > timeout:
+            raise RuntimeError('server_classifier.py did not bind port {} in {} s'.format(port, timeout))
+        try:
+            socket.create_connection(('localhost', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+
+
+def first_judgement(params, img, timeout=60):
+    # -> seconds from starting server_classifier.py to its port being bound
+    # (imports + models loaded), to ready (warm-up done) and to the first
+    # classified frame
+    sparams = params['server']
+    t0 = time.time()
+    server = subprocess.Popen([sys.executable, 'scripts_rpi4/server_classifier.py'], cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(server, sparams['port'], timeout)
+        t_up = time.time() - t0
+        cl = Client('localhost', sparams['port'], zmq_mode=sparams['zmq_mode'], heartbeat=0, wait_ready=True)
+        t_ready = time.time() - t0
+        data = None
+        while data is None and time.time() - t0 < timeout:
+            data = cl.send_img(img)
+        t_judge = time.time() - t0
+        cl.close()
+    finally:
+        server.terminate()
+        server.wait()
+    return {'up_s': t_up, 'ready_s': t_ready, 'judgement_s': t_judge}
+
+
+def test_frame(params):
+    # an evaluation image, as the car sends it; synthetic if there is none
+    for setting in params['evaluation_settings']:
+        directory = os.path.join(ROOT, params[setting]['directory'])
+        files = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        if files:
+            return cv2.imread(os.path.join(directory, files[0]))
+    return np.zeros((720, 1280, 3), np.uint8)
+
+
+def main():
+    # load params
+    params = None
+    with open(os.path.join(ROOT, 'config/default.yaml')) as f:
+        params = yaml.safe_load(f)
+    sparams = params['startup']
+
+    print('--- import time [ms] ---')
+    imports = {}
+    for directory, module in ENTRY_POINTS:
+        total, packages, error = import_times(directory, module)
+        top = ', '.join('{} {:.0f}'.format(p, t) for p, t in packages.most_common(sparams['top']))
+        print('{:28s} {:8.0f}  {}'.format('{}/{}.py'.format(directory, module), total, error or top))
+        imports['{}/{}.py'.format(directory, module)] = {
+            'total_ms': total, 'packages_ms': dict(packages.most_common(sparams['top'])), 'error': error}
+
+    print('--- time to first judgement [s] ---')
+    img = test_frame(params)
+    runs = []
+    for i in range(sparams['runs']):
+        r = first_judgement(params, img, sparams['timeout'])
+        print('run {}: up {up_s:.2f}  ready {ready_s:.2f}  judgement {judgement_s:.2f}'.format(i, **r))
+        runs.append(r)
+    judgement = {k: float(np.median([r[k] for r in runs])) for k in runs[0]} if runs else {}
+
+    out = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'imports': imports,
+        'runs': runs,
+        'judgement': judgement,
+    }
+    with open(sparams['output'], 'w') as f:
+        json.dump(out, f, indent=2)
+    print('saved', sparams['output'])
+
+    if sparams.get('baseline') and judgement:
+        with open(sparams['baseline']) as f:
+            baseline = json.load(f)['judgement']
+        if judgement['judgement_s'] > baseline['judgement_s'] * (1 + sparams['tolerance']):
+            print('REGRESSION judgement_s: {:.2f} -> {:.2f}'.format(baseline['judgement_s'], judgement['judgement_s']))
+            sys.exit(1)
+
+
+# python scripts_rpi4/startup.py (the server must not be running)
+if (__name__ == '__main__'):
+    main()
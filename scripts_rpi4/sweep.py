@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+import json
+import time
+import platform
+import yaml
+
+from train import train, calibration
+from evaluation import evaluation_from_param
+from quantize import load_cnn, calibration_images, latency
+from weights import variant
+
+# Speed/accuracy of `network` per feature tap and input size
+#
+# For every combination of sweep.features and sweep.img_sizes the head is
+# trained (saved as model/<name>_<variant>.pkl, so the chosen point can be
+# served by setting img_size / features), evaluated on every evaluation
+# setting and the CPU latency of the backbone on one image is measured.
+
+
+def sweep_params(params, feature, img_size):
+    # params of one operating point
+    p = dict(params, img_size=img_size, features=dict(params.get('features') or {}))
+    p['features'][params['network']] = feature
+    return p
+
+
+if (__name__ == '__main__'):
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    sparams = params['sweep']
+    network = params['network']
+
+    results = []
+    for feature in sparams['features']:
+        for img_size in sparams['img_sizes']:
+            p = sweep_params(params, feature, img_size)
+            name = variant(network, p)
+            print("--- {} ---".format(name))
+
+            train_params = dict(p['train'], network=network, name=p['name'], img_size=img_size,
+                                features=p['features'], weights_directory=p['weights']['directory'],
+                                calibration=calibration(p))
+            model = train(train_params)
+
+            net = load_cnn(network, dict(p, precision='float32'))
+            img = calibration_images(train_params, 1)[0]
+            r = {'variant': name, 'feature': feature, 'img_size': img_size,
+                 'dim_feature': net.dim_feature, 'latency_ms': latency(net, img, sparams['latency_runs'])}
+
+            base_params = dict(p['evaluation'], network=network, name=p['name'], img_size=img_size,
+                               features=p['features'], print_result=False)
+            for setting in params['evaluation_settings']:
+                eval_params = base_params.copy()
+                eval_params.update(params[setting])
+                print("--- evaluation {} ---".format(setting))
+                r[setting] = evaluation_from_param(model, eval_params, net)
+            results.append(r)
+
+    print("--- accuracy [%] / latency [ms] ({}) ---".format(platform.machine()))
+    print('{:36s} {:>6s} {:>8s} '.format('variant', 'dim', 'latency') +
+          ' '.join('{:>18s}'.format(s) for s in params['evaluation_settings']))
+    for r in sorted(results, key=lambda r: r['latency_ms']):
+        print('{:36s} {:6d} {:8.1f} '.format(r['variant'], r['dim_feature'], r['latency_ms']) +
+              ' '.join('{:18.1f}'.format(r[s] * 100) for s in params['evaluation_settings']))
+
+    out = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'network': network,
+        'results': results,
+    }
+    with open(sparams['output'], 'w') as f:
+        json.dump(out, f, indent=2)
+    print('saved', sparams['output'])
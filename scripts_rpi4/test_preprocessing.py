@@ -0,0 +1,11 @@
+import numpy as np
+
+import util.preprocessing as pre
+
+
+def test_make_squared():
+    img = np.random.default_rng(0).integers(0, 256, (120, 200, 3), dtype=np.uint8)
+    for method in ['WHITE_BG', 'CUTOFF']:
+        assert pre.make_squared(img, {'method': method}).shape == (224, 224, 3)
+        assert pre.make_squared(img, {'method': method}, 128).shape == (128, 128, 3)
+        assert pre.make_squared(img, {'method': method}, (160, 96)).shape == (96, 160, 3)
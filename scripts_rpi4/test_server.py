@@ -0,0 +1,52 @@
+import time
+import socket
+import threading
+import numpy as np
+
+from util import server
+from util.client import AsyncClient
+from util.protocol import REQUEST_FRAME
+
+
+def slow_first(delays):
+    # func whose first call is a cold start
+    def func(img):
+        time.sleep(delays.pop(0) if len(delays) > 1 else delays[0])
+        return {'pred': 1}
+    return func
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_deadline_after_slow_first_call(monkeypatch):
+    monkeypatch.setattr(server, 'service_time', server.ServiceTime())
+    func = slow_first([1.2, 0.05])
+    img = np.zeros((8, 8, 3), np.uint8)
+    answered = 0
+    for i in range(15):
+        meta = {'deadline': time.time() + 1.0}
+        data = server.handle_request(REQUEST_FRAME, meta, [img], func, 4)
+        answered += not server.is_dropped(data)
+    assert answered >= 13
+
+
+def test_async_client_after_slow_first_call(monkeypatch):
+    monkeypatch.setattr(server, 'service_time', server.ServiceTime())
+    port = free_port()
+    threading.Thread(target=server.server_start, daemon=True,
+                     kwargs=dict(port=port, func=slow_first([1.2, 0.05]), zmq_mode=4)).start()
+    cl = AsyncClient('localhost', port, timeout=3000, zmq_mode=4, window=2, deadline=1000, heartbeat=0)
+    img = np.zeros((8, 8, 3), np.uint8)
+    answered = 0
+    for i in range(15):
+        while cl.submit(img) is None:
+            answered += cl.poll(20) is not None
+        answered += cl.poll(200) is not None
+    while cl.in_flight:
+        answered += cl.poll(200) is not None
+    cl.close()
+    assert answered >= 10
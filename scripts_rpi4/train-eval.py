@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
-from train import train
+from train import train, calibration
 from evaluation import evaluation_from_param
+from weights import load_backbone, feature_tap
 import yaml
 
 if (__name__ == '__main__'):
@@ -13,6 +14,10 @@ if (__name__ == '__main__'):
     train_params = params['train']
     train_params['network'] = params['network']
     train_params['name'] = params['name']
+    train_params['weights_directory'] = params['weights']['directory']
+    train_params['img_size'] = params.get('img_size', 224)
+    train_params['features'] = params.get('features')
+    train_params['calibration'] = calibration(params)
 
     trained_model = train(train_params)
 
@@ -21,12 +26,17 @@ if (__name__ == '__main__'):
     base_params = params['evaluation']
     base_params['network'] = params['network']
     base_params['name'] = params['name']
+    base_params['img_size'] = params.get('img_size', 224)
 
     PRINT_RESULT = False
 
+    # one backbone for all settings
+    net = load_backbone(params['network'], params['weights']['directory'], params.get('img_size', 224),
+                        feature_tap(params, params['network']))
+
     for setting in params['evaluation_settings']:
         eval_params = base_params.copy()
         eval_params.update(params[setting])
         # evaluation
         print("--- evaluation {} ---".format(setting))
-        evaluation_from_param(trained_model, eval_params)
+        evaluation_from_param(trained_model, eval_params, net)
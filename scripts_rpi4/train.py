@@ -7,43 +7,70 @@ import yaml
 import sklearn
 import pickle
 
-from img2feat import CNN
 from sklearn.linear_model import LinearRegression
 from sklearn.ensemble import BaggingRegressor
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC, LinearSVC
+from sklearn.calibration import CalibratedClassifierCV
 
 from util.qrcode import detect_roi
 import util.preprocessing as pre
 from util.progressbar import print_progress
+from weights import DIRECTORY, load_backbone, feature_tap, model_filename
 
-IMG_SIZE = (224, 224)
+
+ROTATIONS = [None, cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]
+
+
+def augmentation(img, k):
+    # the k-th of the 8 training images made of one:
+    # img, its rotations, the flipped img, the rotations again
+    if k % 4 == 0:
+        return img if k == 0 else np.fliplr(img).copy()
+    return cv2.rotate(img, ROTATIONS[k % 4])
+
+
+def augment(img):
+    # the 8 training images made of one
+    return [augmentation(img, k) for k in range(8)]
 
 
 def extract_features(net, img):
-    augmented_data = []
-    for i in [img, np.fliplr(img).copy()]:
-        augmented_data.append(i)
-        augmented_data.append(cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE))
-        augmented_data.append(cv2.rotate(img, cv2.ROTATE_180))
-        augmented_data.append(cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE))
-    f = net(augmented_data)
+    f = net(augment(img))
     return f
 
 
-def train_model(X, Y):
+def train_model(X, Y, calibration=None):
     # model = LinearRegression()
     # model = sklearn.neighbors.KNeighborsClassifier(3)
     model = make_pipeline(
         StandardScaler(), LinearSVC(random_state=0, tol=1e-5))
     # model = make_pipeline(StandardScaler(), SVC(gamma='auto'))
+    if calibration is not None:
+        # predict_proba for the confidence the server cascade is gated on
+        # (folds are not shuffled, so the augmented copies of an image mostly stay in one)
+        model = CalibratedClassifierCV(model, method=calibration, cv=5)
     model.fit(X, Y)
     return model
 
 
+def calibration(params):
+    # train.calibration, else sigmoid when the server gates on confidences
+    # (server.cascade, server.cache) and none otherwise: a calibrated head is
+    # fitted once per fold
+    method = params['train'].get('calibration')
+    if method is not None:
+        return method
+    server = params.get('server') or {}
+    if server.get('cascade') or (server.get('cache') or {}).get('size', 0) > 0:
+        return 'sigmoid'
+    return None
+
+
 def train(params):
-    net = CNN(params['network'])
+    net = load_backbone(params['network'], params.get('weights_directory', DIRECTORY),
+                        params.get('img_size', 224), feature_tap(params, params['network']))
 
     X = None
     Y = None
@@ -59,7 +86,7 @@ def train(params):
             continue
         # 前処理
         img = pre.equalization(img, params['equalization'])
-        img = pre.make_squared(img, params['make_squared'])
+        img = pre.make_squared(img, params['make_squared'], params.get('img_size', 224))
         # プレビュー
         if params['preview']:
             cv2.imshow("trained image", img)
@@ -75,11 +102,10 @@ def train(params):
     print("\n")
 
     # 学習
-    model = train_model(X, Y)
+    model = train_model(X, Y, params.get('calibration'))
 
     # 保存
-    filename = params['name'] + '_' + params['network'] + '.pkl'
-    pickle.dump(model, open('model/' + filename, 'wb'))
+    pickle.dump(model, open(model_filename(params, params['network']), 'wb'))
 
     Ypred = model.predict(X)
 
@@ -98,6 +124,10 @@ if (__name__ == '__main__'):
     train_params = params['train']
     train_params['network'] = params['network']
     train_params['name'] = params['name']
+    train_params['weights_directory'] = params['weights']['directory']
+    train_params['img_size'] = params.get('img_size', 224)
+    train_params['features'] = params.get('features')
+    train_params['calibration'] = calibration(params)
 
     # print(train_params)
     # print(eval_params)
@@ -0,0 +1,89 @@
+import time
+import collections
+
+# Decisions per QR code
+#
+# Every card carries its own code, and while the car waits for a judgement
+# the same card is seen on frame after frame. The predictions made for a code
+# are aggregated here; once enough of them agree, the decision is returned
+# for the following frames and the classifier is not run for them.
+
+class DecisionCache:
+    '''
+    LRU cache: code -> votes of the predictions made for it.
+    size:       codes kept, the least recently used one is evicted
+    ttl:        [s] an entry older than this is dropped (the card may have
+                been swapped for another with the same code)
+    min_frames: predictions needed before a decision is returned
+    threshold:  share of the (confidence weighted) votes the decision needs
+    '''
+    def __init__( self, size=64, ttl=30, min_frames=3, threshold=0.8 ):
+        self.size = size
+        self.ttl = ttl
+        self.min_frames = min_frames
+        self.threshold = threshold
+        self.entries = collections.OrderedDict() # code -> { 'time', 'frames', 'votes': {pred: weight} }
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def entry( self, code, t=None ):
+        e = self.entries.get( code )
+        if( e is None ):
+            return None
+        if( ( time.time() if t is None else t ) - e['time'] > self.ttl ):
+            del self.entries[code]
+            self.expirations += 1
+            return None
+        return e
+
+    def get( self, code ):
+        '''
+        -> (pred, confidence) once the code has a confident decision, else None
+        '''
+        e = None if code is None else self.entry( code )
+        decision = None if e is None else self.decision( e )
+        if( decision is None or e['frames'] < self.min_frames or decision[1] < self.threshold ):
+            self.misses += 1
+            return None
+        self.entries.move_to_end( code )
+        self.hits += 1
+        return decision
+
+    def add( self, code, pred, confidence=1.0 ):
+        '''
+        One more prediction for code. -> aggregated (pred, confidence)
+        '''
+        if( code is None or pred is None ):
+            return None
+        t = time.time()
+        e = self.entry( code, t )
+        if( e is None ):
+            e = { 'time': t, 'frames': 0, 'votes': collections.Counter() }
+            self.entries[code] = e
+            while( len(self.entries) > self.size ):
+                self.entries.popitem( last=False )
+                self.evictions += 1
+        self.entries.move_to_end( code )
+        e['frames'] += 1
+        e['votes'][pred] += confidence
+        return self.decision( e )
+
+    def decision( self, e ):
+        total = sum( e['votes'].values() )
+        if( total <= 0 ):
+            return None
+        pred, weight = e['votes'].most_common( 1 )[0]
+        return pred, weight / total
+
+    def counters( self ):
+        return dict( size=len(self.entries), hits=self.hits, misses=self.misses,
+                     evictions=self.evictions, expirations=self.expirations )
+
+    def __str__( self ):
+        return 'cache: {size} codes, hits {hits}, misses {misses}, evictions {evictions}, expirations {expirations}'.format(
+            **self.counters() )
@@ -2,24 +2,22 @@ import sys
 import zmq
 import json
 import time
+import random
 import numpy as np
+from zmq.utils.monitor import recv_monitor_message
 
-import zlib
-try:
-   import cPickle as pickle
-except:
-   import pickle
+# zlib/pickle (zmq_mode 1) and cv2 (zmq_mode 3) are imported by the modes
+# that use them, so the car does not pay for them at startup
 
-try:
-    # python 2
-    from StringIO import StringIO as io_memory
-except ImportError:
-    # python 3
-    from io import BytesIO as io_memory
+from util.protocol import WIRE_VERSION, WIRE_VERSIONS, REQUEST_FRAME, REQUEST_ROI, REQUEST_BATCH, pack_array, pack_header, pack_slot
+from util.protocol import REPLY_JSON, REPLY_VERSION, unpack_reply
+from util.trace import estimate_offset
+from util.shm import FrameRing
 
-from PIL import Image
+def send_numpy_array( socket, np_array, mode=None, q=75, frame_id=0, t_capture=0.0, version=WIRE_VERSION, more=False, ring=None ):
+    # more: further frames of the same request follow
+    flags = zmq.SNDMORE if more else 0
 
-def send_numpy_array( socket, np_array, mode=None, q=75 ):
     if( mode == 0 ):
         # https://pyzmq.readthedocs.io/en/latest/serialization.html
         md = dict(
@@ -27,25 +25,85 @@ def send_numpy_array( socket, np_array, mode=None, q=75 ):
             shape = np_array.shape,
         )
         socket.send_json(md, zmq.SNDMORE)
-        socket.send(np_array)
+        socket.send(np.ascontiguousarray(np_array), flags, copy=False)
+        nbytes = np_array.nbytes
 
     elif( mode == 1 ):
+        import zlib
+        import pickle
         p = pickle.dumps(np_array, protocol=3)
         z = zlib.compress(p)
-        socket.send(z)
+        socket.send(z, flags)
+        nbytes = len(z)
 
     elif( mode == 2 ):
         # https://blog.futurestandard.jp/entry/2017/02/27/151741
         dtype = str(np_array.dtype).encode('utf-8')
         shape = json.dumps(np_array.shape).encode('utf-8')
-        array = np_array.tostring('C')
-        socket.send_multipart([dtype, shape, array])
+        array = np.ascontiguousarray(np_array)
+        socket.send(dtype, zmq.SNDMORE)
+        socket.send(shape, zmq.SNDMORE)
+        socket.send(array, flags, copy=False)
+        nbytes = array.nbytes
 
     elif( mode == 3 ):
-        buffer = io_memory()
-        Image.fromarray(np_array).save( buffer, 'JPEG', quality = q )
-        buffer.seek(0)
-        socket.send(buffer.read())
+        # the camera frame is BGR, as util.jpeg.JpegDecoder returns it
+        import cv2
+        ok, b = cv2.imencode( '.jpg', np_array, [ cv2.IMWRITE_JPEG_QUALITY, int(q) ] )
+        if( not ok ):
+            raise ValueError( 'cv2.imencode failed' )
+        socket.send(b, flags)
+        nbytes = len(b)
+
+    elif( mode == 4 ):
+        # binary header + raw array memory, see util/protocol.py
+        header, payload = pack_array( np_array, frame_id, t_capture, time.time(), version )
+        socket.send(header, zmq.SNDMORE)
+        socket.send(payload, flags, copy=False)
+        nbytes = payload.nbytes
+
+    elif( mode == 5 ):
+        # copied into a shared memory slot (util.shm.FrameRing), only its place is sent
+        dst, slot, offset, seq = ring.put( np_array )
+        header = pack_header( dst, frame_id, t_capture, time.time(), version )
+        desc = pack_slot( ring.name, slot, offset, seq )
+        socket.send(header, zmq.SNDMORE)
+        socket.send(desc, flags)
+        nbytes = len(header) + len(desc)
+
+    else:
+        nbytes = 0
+
+    # payload bytes put on the wire
+    return nbytes
+
+def roi_request( roi, code, rect, roi_rect, thumb=None, shape=None ):
+    '''
+    Request for a QR code already located on the client (see util.qrcode.detect_roi).
+    Only the colour ROI crop and an optional low resolution thumbnail of the
+    frame (for the server preview) are uploaded.
+    '''
+    meta = dict(
+        code = code,
+        rect = list(rect),
+        roi_rect = list(roi_rect),
+        shape = None if shape is None else list(shape),
+        thumb = thumb is not None,
+    )
+    arrays = [roi] if thumb is None else [roi, thumb]
+    return REQUEST_ROI, meta, arrays
+
+def batch_request( arrays, rois=None ):
+    '''
+    Request for several frames at once, e.g. a short burst from the camera,
+    or with rois [(code, rect, roi_rect)] for several ROIs located on the
+    client. The server runs one forward pass over all of them; the reply has
+    one result per array in reply['batch'].
+    '''
+    meta = {}
+    if( rois is not None ):
+        meta['rois'] = [ dict( code=code, rect=list(rect), roi_rect=list(roi_rect) ) for code, rect, roi_rect in rois ]
+    return REQUEST_BATCH, meta, list(arrays)
 
 def receive_dict( socket, poller=None, timeout=1000 ):
     if( poller is None ):
@@ -57,75 +115,376 @@ def receive_dict( socket, poller=None, timeout=1000 ):
     data = None
     for s in socks:
         if( s == socket ):
-            data = s.recv_json()
+            data = unpack_reply( s.recv() )
 
     return data
 
+class Backoff:
+    '''
+    Exponential backoff with full jitter: the n-th retry waits a random
+    time in [0, min(cap, base * 2**n)] [ms].
+    '''
+    def __init__( self, base=10, cap=1000 ):
+        self.base = base
+        self.cap = cap
+        self.n = 0
+
+    def next( self ):
+        delay = random.uniform( 0, min( self.cap, self.base * 2**self.n ) )
+        self.n = min( self.n + 1, 32 )
+        return delay
+
+    def reset( self ):
+        self.n = 0
+
+# the peer is usable once the ZMTP handshake is done
+EVENT_UP = getattr( zmq, 'EVENT_HANDSHAKE_SUCCEEDED', zmq.EVENT_CONNECTED )
+
 class Client:
-    def __init__( self, host = 'localhost', port = 5556, timeout=1000, zmq_mode=None ):
+    '''
+    One zmq.Context for the lifetime of the client. libzmq reconnects the
+    socket by itself (backoff from reconnect_ivl, doubled up to
+    reconnect_ivl_max); ZMTP heartbeats every `heartbeat` [ms] drop a dead
+    connection, and a socket monitor tells whether the server is up, so a
+    frame is not sent into a connection that is known to be gone.
+
+    Counters: reconnects, lost_frames (sent, never answered) and
+    skipped_frames (not sent, server down).
+
+    wait_ready: the constructor returns only once the server reports in the
+    hello that its models are warmed up.
+    '''
+    socket_type = zmq.REQ
+
+    def __init__( self, host = 'localhost', port = 5556, timeout=1000, zmq_mode=None, controller=None, binary_reply=False,
+                  heartbeat=500, backoff=(10, 1000), stats=None, deadline=0, wait_ready=True ):
         self.host = host
         self.port = port
         self.timeout = timeout
-
-        self.context = None
+        self.heartbeat = heartbeat
+        self.backoff = Backoff( *backoff )
+        self.controller = None
+        self.stats = None
+        self.deadline = 0
+        self.uid = random.getrandbits(32) # correlation ids: uid-frame_id
+        self.clock_offset = 0.0 # server clock - client clock
+
+        self.context = zmq.Context()
         self.socket = None
+        self.monitor = None
+        self.up = False
+        self.retry_at = 0.0
         self.zmq_mode = zmq_mode
-
+        self.ring = None # zmq_mode 5 frame slots
+        self.old_rings = [] # (first frame id of the next ring, ring) still read by the server
+        self.frame_id = 0
+
+        self.connects = 0
+        self.reconnects = 0
+        self.lost_frames = 0
+        self.skipped_frames = 0
+        self.dropped_frames = 0
+
+        # the hello goes out in the oldest wire version every server understands
+        self.wire_version = WIRE_VERSIONS[0]
+        self.reply_version = REPLY_JSON
         hello = np.zeros( (1,1,3), dtype=np.uint8 )
+        waiting = False
         while( True ):
-            data = self.send_img( hello )
-            if( data is None ):
-                self.disconnect()
-                time.sleep(1)
-            else:
+            self.connect()
+            data = None
+            if( self.alive( self.timeout ) ):
+                t0 = time.time()
+                data = self.send_img( hello )
+                t1 = time.time()
+            if( data is not None and ( not wait_ready or data.get('ready', True) ) ):
                 break
+            if( data is not None and not waiting ):
+                print( 'waiting for the server to warm up' )
+                waiting = True
+            time.sleep( self.backoff.next() / 1000 )
+        self.backoff.reset()
+        if( 'time' in data ):
+            self.clock_offset, rtt = estimate_offset( [(t0, data['time'], t1)] )
+
+        # then both sides use the newest version they have in common
+        self.wire_version = min( WIRE_VERSION, data.get('wire', WIRE_VERSIONS[0]) )
+        if( binary_reply ):
+            # servers without the binary reply do not advertise it
+            self.reply_version = min( REPLY_VERSION, data.get('reply', REPLY_JSON) )
+
+        if( stats is not None or deadline > 0 ):
+            self.sync_clock( hello )
+
+        # util.adaptive.AdaptiveQuality: JPEG quality from measured latency,
+        # util.trace.LatencyStats: per-stage latency of traced requests;
+        # neither is fed with the hello round trips
+        self.controller = controller
+        self.stats = stats
+        # deadline > 0: results of frames captured more than deadline [ms] ago
+        # are of no use; the server drops them before inference
+        self.deadline = deadline
 
     def __del__( self ):
-        self.disconnect()
+        self.close()
 
     def connect( self ):
-        if( self.context is None and self.socket is None ):
-            self.context = zmq.Context()
-            self.socket = self.context.socket(zmq.REQ)
+        if( self.socket is None and self.context is not None ):
+            self.socket = self.context.socket(self.socket_type)
 
-            self.socket.setsockopt(zmq.LINGER, self.timeout)
+            # nothing queued for a dead server is worth sending later
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.setsockopt(zmq.IMMEDIATE, 1)
             self.socket.setsockopt(zmq.RCVTIMEO, self.timeout)
             self.socket.setsockopt(zmq.SNDTIMEO, self.timeout)
-
-            con = 'tcp://{host}:{port}'.format(host=self.host, port=self.port)
+            self.socket.setsockopt(zmq.RECONNECT_IVL, self.backoff.base)
+            self.socket.setsockopt(zmq.RECONNECT_IVL_MAX, self.backoff.cap)
+            if( self.heartbeat > 0 ):
+                self.socket.setsockopt(zmq.HEARTBEAT_IVL, self.heartbeat)
+                self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 3*self.heartbeat)
+            if( self.socket_type == zmq.REQ ):
+                # a request without reply does not wedge the socket,
+                # and its late reply is dropped
+                self.socket.setsockopt(zmq.REQ_RELAXED, 1)
+                self.socket.setsockopt(zmq.REQ_CORRELATE, 1)
+
+            self.monitor = self.socket.get_monitor_socket( EVENT_UP | zmq.EVENT_DISCONNECTED )
+            self.up = False
+
+            # host may also be a full endpoint, e.g. ipc:///tmp/server
+            con = self.host if '://' in self.host else 'tcp://{host}:{port}'.format(host=self.host, port=self.port)
             self.socket.connect(con)
 
             self.poller = zmq.Poller()
             self.poller.register(self.socket, zmq.POLLIN)
+            self.poller.register(self.monitor, zmq.POLLIN)
 
     def disconnect( self ):
         if( self.socket is not None ):
+            self.socket.disable_monitor()
+            self.monitor.close()
             self.socket.close()
             self.socket = None
+            self.monitor = None
+            self.up = False
 
+    def close( self ):
+        self.disconnect()
         if( self.context is not None ):
-            self.context.destroy()
+            self.context.term()
             self.context = None
+        if( self.ring is not None ):
+            self.ring.close()
+            self.ring = None
+        for frame_id, ring in self.old_rings:
+            ring.close()
+        self.old_rings = []
+
+    def release_rings( self ):
+        # closes the replaced rings no frame in flight is in anymore
+        in_flight = getattr( self, 'in_flight', {} )
+        keep = []
+        for frame_id, ring in self.old_rings:
+            if( any( i < frame_id for i in in_flight ) ):
+                keep.append( ( frame_id, ring ) )
+            else:
+                ring.close()
+        self.old_rings = keep
+
+    def alive( self, timeout=0 ):
+        '''
+        Whether the connection to the server is up, after waiting at most
+        timeout [ms] for it to come up.
+        '''
+        if( self.socket is None ):
+            return False
+        t_end = time.time() + timeout / 1000
+        while( True ):
+            self.update_state()
+            rest = t_end - time.time()
+            if( self.up or rest <= 0 or not self.monitor.poll( rest*1000 ) ):
+                return self.up
+
+    def update_state( self ):
+        # drain the socket monitor; False if the connection went down
+        was_up = self.up
+        while( self.monitor.poll(0) ):
+            event = recv_monitor_message( self.monitor )['event']
+            if( event == EVENT_UP ):
+                self.up = True
+                self.connects += 1
+                self.reconnects = self.connects - 1
+            elif( event == zmq.EVENT_DISCONNECTED ):
+                self.up = False
+        return self.up or not was_up
+
+    def on_error( self ):
+        # new socket, not a new context; retried only after a backoff
+        print( '***** ERROR: ZMQ {host}:{port} *****'.format(host=self.host, port=self.port ), file=sys.stderr )
+        self.disconnect()
+        self.retry_at = time.time() + self.backoff.next() / 1000
 
-    def send_img( self, img ):
+    def sync_clock( self, hello, n=8 ):
+        # server clock offset from the hello round trip with the least delay
+        samples = []
+        for i in range(n):
+            t0 = time.time()
+            data = self.send_img( hello )
+            t1 = time.time()
+            if( data is not None and 'time' in data ):
+                samples.append( (t0, data['time'], t1) )
+        if( samples ):
+            self.clock_offset, rtt = estimate_offset( samples )
+            print( 'clock offset: {:.4f} s (+-{:.4f})'.format( self.clock_offset, rtt/2 ) )
+
+    def write_request( self, arrays, kind=None, meta=None, frame_id=0, t_capture=None ):
+        if( t_capture is None ):
+            t_capture = time.time()
+        q = 75 if self.controller is None else self.controller.quality
+        if( self.reply_version > REPLY_JSON or self.stats is not None or self.deadline > 0 ):
+            # reply encoding, tracing and deadline go in the request meta
+            if( kind is None ):
+                kind, meta = REQUEST_FRAME, {}
+            meta = dict( meta )
+            if( self.reply_version > REPLY_JSON ):
+                meta['reply'] = self.reply_version
+            if( self.stats is not None ):
+                meta['trace'] = '{:08x}-{}'.format( self.uid, frame_id )
+            if( self.deadline > 0 ):
+                # on the server clock
+                meta['deadline'] = t_capture + self.deadline / 1000 + self.clock_offset
+        if( kind is not None ):
+            self.socket.send( kind, zmq.SNDMORE )
+            self.socket.send_json( meta, zmq.SNDMORE )
+        if( self.zmq_mode == 5 ):
+            # up to 2 arrays (or a batch) per request in flight, and one more request being previewed
+            slots = ( getattr( self, 'window', 1 ) + 1 ) * max( 2, len(arrays) )
+            slot_size = max( [1280*720*3] + [ a.nbytes for a in arrays ] )
+            self.release_rings()
+            if( self.ring is None or self.ring.slots < slots or self.ring.slot_size < slot_size ):
+                # a new segment for a larger batch or frame; the old one stays
+                # until the requests in flight in it are answered
+                if( self.ring is not None ):
+                    self.old_rings.append( ( frame_id, self.ring ) )
+                self.ring = FrameRing( slots, slot_size )
+        nbytes = 0
+        for i, a in enumerate(arrays):
+            nbytes += send_numpy_array( self.socket, a, self.zmq_mode, q, frame_id=frame_id, t_capture=t_capture,
+                                        version=self.wire_version, more=( i < len(arrays)-1 ), ring=self.ring )
+        return nbytes
+
+    def measure( self, t0, encode_time, nbytes, data, level=None ):
+        # feed one round trip (data None: lost) to the controller and the stats
+        if( self.stats is not None and data is not None ):
+            self.record( t0, encode_time, data )
+        if( self.controller is None ):
+            return
+        if( data is None ):
+            self.controller.update( encode_time, nbytes, None, level=level )
+        else:
+            self.controller.update( encode_time, nbytes, time.time() - t0, data.get('server_time', 0.0),
+                                    data.get('rect'), level )
+
+    def record( self, t0, encode_time, data ):
+        # server stamps are moved to the client clock with clock_offset
+        t1 = time.time()
+        stamps = data.get('trace')
+        if( stamps is None ):
+            return
+        self.stats.add( 'encode', encode_time )
+        if( 'recv' in stamps ):
+            self.stats.add( 'send', stamps['recv'] - self.clock_offset - (t0 + encode_time) )
+        self.stats.add_stamps( stamps )
+        if( 'reply' in stamps ):
+            self.stats.add( 'receive', t1 - (stamps['reply'] - self.clock_offset) )
+        self.stats.add( 'total', t1 - t0 )
+
+    def send_img( self, img, t_capture=None ):
         if( img is None ):
             return None
+        return self.send_request( [img], t_capture=t_capture )
+
+    def send_roi( self, roi, code, rect, roi_rect, thumb=None, shape=None, t_capture=None ):
+        kind, meta, arrays = roi_request( roi, code, rect, roi_rect, thumb, shape )
+        return self.send_request( arrays, kind, meta, t_capture )
+
+    def send_batch( self, imgs, rois=None, t_capture=None ):
+        # -> reply with reply['batch'], see batch_request
+        kind, meta, arrays = batch_request( imgs, rois )
+        return self.send_request( arrays, kind, meta, t_capture )
+
+    def connected( self ):
+        # connect unless backing off after an error, and check the server is up
+        if( time.time() < self.retry_at ):
+            return False
         self.connect()
+        if( self.alive( self.backoff.base ) ):
+            self.backoff.reset()
+            return True
+        return False
+
+    def receive( self, timeout ):
+        # reply, or None on timeout or when the connection drops meanwhile
+        t_end = time.time() + timeout / 1000
+        while( True ):
+            rest = t_end - time.time()
+            if( rest <= 0 ):
+                return None
+            socks = dict( self.poller.poll( rest*1000 ) )
+            if( self.socket in socks ):
+                try:
+                    return unpack_reply( self.socket.recv( zmq.NOBLOCK ) )
+                except zmq.Again:
+                    # REQ_CORRELATE discarded a late reply to an earlier request;
+                    # a blocking recv would wait RCVTIMEO on top of what has passed
+                    continue
+            if( self.monitor in socks and not self.update_state() ):
+                return None
+
+    def expired( self, t_capture, t=None ):
+        # the deadline of a frame captured at t_capture has passed
+        if( self.deadline <= 0 ):
+            return False
+        return ( time.time() if t is None else t ) > t_capture + self.deadline / 1000
+
+    def dropped( self, data ):
+        # the server dropped the request (deadline passed, or a newer frame was waiting)
+        if( data is not None and 'Dropped' in data ):
+            self.dropped_frames += 1
+            return True
+        return False
+
+    def send_request( self, arrays, kind=None, meta=None, t_capture=None ):
+        if( not self.connected() ):
+            self.skipped_frames += 1
+            return None
 
+        self.frame_id += 1
+        t0 = time.time()
+        if( t_capture is None ):
+            t_capture = t0
         try:
-            send_numpy_array( self.socket, img, self.zmq_mode )
-            data = receive_dict( self.socket, self.poller, self.timeout )
+            nbytes = self.write_request( arrays, kind, meta, self.frame_id, t_capture )
+            encode_time = time.time() - t0
+            data = self.receive( self.timeout )
         except zmq.error.ZMQError:
-            print( '***** ERROR: ZMQ {host}:{port} *****'.format(host=self.host, port=self.port ), file=sys.stderr )
-            self.disconnect()
-            time.sleep(0.1)
-            self.connect()
+            self.lost_frames += 1
+            self.on_error()
+            return None
+
+        if( self.dropped( data ) ):
+            return None
+
+        self.measure( t0, encode_time, nbytes, data )
+
+        if( data is not None and self.expired( t_capture ) ):
+            # too late to act on
+            self.dropped_frames += 1
             return None
 
         if( data is None ):
-            self.disconnect()
-            time.sleep(0.1)
-            self.connect()
+            # REQ_RELAXED: the socket takes the next request as is
+            self.lost_frames += 1
 
         elif( 'Error' in data.keys() ):
             print( '***** Server Error *****', file=sys.stderr)
@@ -134,28 +493,226 @@ class Client:
 
         return data
 
+def pack_frame_id( frame_id ):
+    return frame_id.to_bytes(8, 'little')
+
+def unpack_frame_id( b ):
+    return int.from_bytes(b, 'little')
+
+class AsyncClient( Client ):
+    '''
+    Pipelined client on a DEALER socket.
+
+    Every request is sent as [frame_id, b'', body...]. The frame id sits in the
+    envelope, so REP and ROUTER servers echo it back unchanged and replies can
+    be matched to their frames. Up to `window` frames are in flight at once,
+    which lets capture/encode of the next frame overlap with server inference
+    of the previous one.
+    '''
+    socket_type = zmq.DEALER
+
+    def __init__( self, host = 'localhost', port = 5556, timeout=1000, zmq_mode=None, window=2, controller=None, binary_reply=False,
+                  heartbeat=500, backoff=(10, 1000), stats=None, deadline=0, wait_ready=True ):
+        self.window = max( 1, window )
+        self.in_flight = {} # frame_id -> (send time, encode time, bytes, resolution level, capture time)
+        self.latest_id = -1
+        self.latest_data = None
+        self.service_time = 0.0 # server_time of the last reply [s]
+        super().__init__( host, port, timeout, zmq_mode, controller, binary_reply, heartbeat, backoff, stats, deadline, wait_ready )
+
+    def ready( self ):
+        return len(self.in_flight) < self.window and self.connected()
+
+    def submit( self, img, t_capture=None ):
+        '''
+        Send img without waiting for the reply.
+        Returns the frame id, or None when the window is full, the reply could
+        not arrive before the deadline or sending failed.
+        '''
+        if( img is None ):
+            return None
+        return self.submit_request( [img], t_capture=t_capture )
+
+    def submit_roi( self, roi, code, rect, roi_rect, thumb=None, shape=None, t_capture=None ):
+        kind, meta, arrays = roi_request( roi, code, rect, roi_rect, thumb, shape )
+        return self.submit_request( arrays, kind, meta, t_capture )
+
+    def submit_batch( self, imgs, rois=None, t_capture=None ):
+        kind, meta, arrays = batch_request( imgs, rois )
+        return self.submit_request( arrays, kind, meta, t_capture )
+
+    def submit_request( self, arrays, kind=None, meta=None, t_capture=None ):
+        if( len(self.in_flight) >= self.window ):
+            return None
+        if( not self.connected() ):
+            self.skipped_frames += 1
+            return None
+
+        t0 = time.time()
+        if( t_capture is None ):
+            t_capture = t0
+        if( self.in_flight and self.expired( t_capture, t0 + self.service_time ) ):
+            # the result would arrive after the deadline; with nothing in flight
+            # the frame goes anyway, as no reply could correct the estimate
+            self.dropped_frames += 1
+            return None
+
+        self.frame_id += 1
+        frame_id = self.frame_id
+        try:
+            self.socket.send( pack_frame_id(frame_id), zmq.SNDMORE )
+            self.socket.send( b'', zmq.SNDMORE )
+            nbytes = self.write_request( arrays, kind, meta, frame_id, t_capture )
+        except zmq.error.ZMQError:
+            self.lost_frames += 1
+            self.reset()
+            return None
+
+        level = None if self.controller is None else self.controller.level
+        self.in_flight[frame_id] = ( t0, time.time() - t0, nbytes, level, t_capture )
+        return frame_id
+
+    def poll( self, timeout=0 ):
+        '''
+        Collect finished replies and return the newest one not returned yet.
+        Waits at most timeout [ms] for a reply; returns None if nothing new.
+        '''
+        if( self.socket is None ):
+            return None
+
+        dropped = False
+        try:
+            while( True ):
+                socks = dict( self.poller.poll(timeout) )
+                if( not socks ):
+                    break
+                if( self.monitor in socks and not self.update_state() ):
+                    dropped = True
+                    break
+                if( self.socket in socks ):
+                    self.on_reply( self.socket.recv_multipart( zmq.NOBLOCK ) )
+                    timeout = 0
+        except zmq.error.ZMQError:
+            self.reset()
+            return None
+
+        # frames the server has not answered within timeout are lost,
+        # and all of them when the connection dropped; frames past their
+        # deadline are given up as well, they free the window for new ones
+        t = time.time()
+        for i, r in list( self.in_flight.items() ):
+            if( dropped or (t-r[0])*1000 > self.timeout ):
+                self.lost_frames += 1
+            elif( self.expired( r[4], t ) ):
+                self.dropped_frames += 1
+            else:
+                continue
+            del self.in_flight[i]
+            self.measure( *r[:3], None )
+
+        data = self.latest_data
+        self.latest_data = None
+        return data
+
+    def on_reply( self, frames ):
+        if( len(frames) < 3 or frames[1] != b'' ):
+            return
+        frame_id = unpack_frame_id( frames[0] )
+        r = self.in_flight.pop( frame_id, None )
+        if( r is None ):
+            return # flushed or timed out
+
+        data = unpack_reply( frames[-1] )
+        if( self.dropped( data ) ):
+            return
+        self.service_time = data.get( 'server_time', self.service_time )
+        self.measure( *r[:3], data, r[3] )
+        if( 'Error' in data.keys() ):
+            print( '***** Server Error *****', file=sys.stderr)
+            print( data['Error'], file=sys.stderr)
+            print( '************************', file=sys.stderr)
+
+        if( self.expired( r[4] ) ):
+            self.dropped_frames += 1
+            return
+
+        # an older frame finishing late never replaces a newer result
+        if( frame_id > self.latest_id ):
+            self.latest_id = frame_id
+            self.latest_data = data
+
+    def flush( self ):
+        '''
+        Forget everything in flight; replies to those frames are dropped.
+        '''
+        self.in_flight.clear()
+        self.latest_id = self.frame_id
+        self.latest_data = None
+
+    def disconnect( self ):
+        # replies to frames sent on the old socket can never arrive
+        self.flush()
+        super().disconnect()
+
+    def reset( self ):
+        self.flush()
+        self.on_error()
+
+    def send_request( self, arrays, kind=None, meta=None, t_capture=None ):
+        frame_id = self.submit_request( arrays, kind, meta, t_capture )
+        if( frame_id is None ):
+            return None
+
+        t0 = time.time()
+        while( True ):
+            rest = self.timeout - int( (time.time()-t0)*1000 )
+            data = self.poll( max( rest, 0 ) )
+            if( self.latest_id == frame_id ):
+                return data
+            if( rest <= 0 or frame_id not in self.in_flight ):
+                break
+
+        if( self.in_flight.pop( frame_id, None ) is not None ):
+            self.lost_frames += 1
+        return None
+
 if( __name__ == '__main__'):
     import cv2
-    # python client.py localhost 5556
+    # python client.py localhost 5556 3 [window]
 
     host = sys.argv[1]
     port = int(sys.argv[2])
     zmq_mode = int(sys.argv[3]) # default 3
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 0
 
     print( 'host:', host )
     print( 'port:', port )
     print( 'zmq_mode:', zmq_mode )
+    print( 'window:', window )
 
     img = cv2.imread('client.jpg')
-    cl = Client( host, port, zmq_mode=zmq_mode )
+    if( window > 0 ):
+        cl = AsyncClient( host, port, zmq_mode=zmq_mode, window=window )
+    else:
+        cl = Client( host, port, zmq_mode=zmq_mode )
 
     N=10
     t0 = time.time()
-    for i in range(N):
-        data = cl.send_img( img )
+    if( window > 0 ):
+        sent = 0
+        while( sent < N or cl.in_flight ):
+            if( sent < N and cl.submit( img ) is not None ):
+                sent += 1
+            d = cl.poll( 0 if sent < N and cl.ready() else cl.timeout )
+            if( d is not None ):
+                data = d
+    else:
+        for i in range(N):
+            data = cl.send_img( img )
     t1 = time.time()
 
     print(data)
-    print( (t1-t0)/10 )
+    print( (t1-t0)/N )
+    print( 'reconnects:', cl.reconnects, 'lost:', cl.lost_frames, 'skipped:', cl.skipped_frames )
 
-    cl.disconnect()
+    cl.close()
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+
+try:
+    # python 2
+    from StringIO import StringIO as io_memory
+except ImportError:
+    # python 3
+    from io import BytesIO as io_memory
+
+# PIL is imported by the 'pil' backend only
+
+# optional libjpeg-turbo bindings
+try:
+    # decode into a given buffer, DCT-domain scaling
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+try:
+    # lossless crop in the DCT domain
+    from turbojpeg import TurboJPEG, TJPF_BGR, tjMCUWidth, tjMCUHeight
+except ImportError:
+    TurboJPEG = None
+
+CV2_REDUCED = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+BACKENDS = ['pil', 'cv2', 'simplejpeg']
+
+class JpegDecoder:
+    '''
+    JPEG -> BGR ndarray.
+
+    backend:
+      'pil'        Image.open + np.asarray (the old zmq_mode 3 path), converted to BGR
+      'cv2'        cv2.imdecode, IMREAD_REDUCED_COLOR_* for scale > 1
+      'simplejpeg' libjpeg-turbo decoding into a buffer reused between frames
+      None         simplejpeg if installed, else cv2
+    scale: 1, 2, 4 or 8. Scaling is done by libjpeg in the DCT domain.
+
+    The returned array may be overwritten by the next decode into the same
+    slot; copy it if it has to outlive the current request. Arrays of one
+    request are decoded into different slots.
+    '''
+    def __init__( self, backend=None, scale=1 ):
+        if( backend is None ):
+            backend = 'cv2' if simplejpeg is None else 'simplejpeg'
+        if( not backend in BACKENDS ):
+            raise ValueError( 'unknown jpeg backend {}, one of {}'.format( backend, BACKENDS ) )
+        if( backend == 'simplejpeg' and simplejpeg is None ):
+            raise ImportError( 'simplejpeg is not installed.' )
+        if( not scale in CV2_REDUCED ):
+            raise ValueError( 'scale must be 1, 2, 4 or 8' )
+
+        self.backend = backend
+        self.scale = scale
+        self.buffers = {} # slot -> reused output buffer
+
+        self.turbo = None
+        if( TurboJPEG is not None ):
+            try:
+                self.turbo = TurboJPEG()
+            except OSError:
+                # libturbojpeg.so is missing
+                self.turbo = None
+
+    def __call__( self, b ):
+        return self.decode( b )
+
+    def decode( self, b, scale=None, slot=0 ):
+        if( scale is None ):
+            scale = self.scale
+
+        if( self.backend == 'simplejpeg' ):
+            # libjpeg picks the largest reduction that keeps min_height x min_width
+            h, w, _, _ = simplejpeg.decode_jpeg_header( b )
+            h, w = -(-h//scale), -(-w//scale)
+            size = h * w * 3
+            buffer = self.buffers.get( slot )
+            if( buffer is None or buffer.size < size ):
+                buffer = np.empty( size, dtype=np.uint8 )
+                self.buffers[slot] = buffer
+            return simplejpeg.decode_jpeg( b, 'BGR', min_height=h, min_width=w, buffer=buffer )
+
+        if( self.backend == 'cv2' ):
+            img = cv2.imdecode( np.frombuffer( b, dtype=np.uint8 ), CV2_REDUCED[scale] )
+            if( img is None ):
+                raise ValueError( 'cv2.imdecode failed' )
+            return img
+
+        from PIL import Image
+        img = Image.open( io_memory(b) )
+        if( scale > 1 ):
+            img.draft( 'RGB', (img.size[0]//scale, img.size[1]//scale) )
+        if( img.mode != 'RGB' ):
+            img = img.convert( 'RGB' )
+        return cv2.cvtColor( np.asarray(img), cv2.COLOR_RGB2BGR )
+
+    def decode_roi( self, b, rect ):
+        '''
+        Full resolution crop of rect (left, top, width, height).
+        With libturbojpeg only the iMCU rows/columns covering rect are
+        decoded; otherwise the frame is decoded and a view is returned.
+        '''
+        if( self.turbo is not None ):
+            width, height, subsample, _ = self.turbo.decode_header( b )
+            mcu_w = tjMCUWidth[subsample]
+            mcu_h = tjMCUHeight[subsample]
+            left = (rect.left // mcu_w) * mcu_w
+            top = (rect.top // mcu_h) * mcu_h
+            right = min( rect.left + rect.width, width )
+            bottom = min( rect.top + rect.height, height )
+
+            crop = self.turbo.crop( b, left, top, right - left, bottom - top )
+            img = self.turbo.decode( crop, pixel_format=TJPF_BGR )
+            return img[ rect.top-top:bottom-top, rect.left-left:right-left ]
+
+        img = self.decode( b, 1 )
+        return img[ rect.top:rect.top+rect.height, rect.left:rect.left+rect.width ]
+
+if( __name__ == '__main__' ):
+    # python jpeg.py [image] [N]
+    # decode time of a 1280x720 JPEG (q=75, as zmq_mode 3 sends it)
+    import sys
+    import time
+    from PIL import Image
+    from pyzbar.locations import Rect
+
+    if( len(sys.argv) > 1 ):
+        img = cv2.imread( sys.argv[1] )
+    else:
+        y, x = np.mgrid[0:720, 0:1280]
+        img = np.stack( [ x*255//1280, y*255//720, (x+y)%256 ], axis=2 ).astype(np.uint8)
+        img = cv2.GaussianBlur( img, (5,5), 0 )
+    N = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    b = cv2.imencode( '.jpg', img, [ cv2.IMWRITE_JPEG_QUALITY, 75 ] )[1].tobytes()
+    roi = Rect( left=img.shape[1]//2-112, top=img.shape[0]//2-112, width=224, height=224 )
+
+    def bench( name, func ):
+        func()
+        t0 = time.time()
+        for i in range(N):
+            out = func()
+        t1 = time.time()
+        print( '{:32s} {:8.3f} ms  {}'.format( name, (t1-t0)/N*1000, out.shape ) )
+
+    print( 'jpeg:', len(b), 'bytes', img.shape )
+    bench( 'PIL open + asarray (old, RGB)', lambda: np.asarray( Image.open( io_memory(b) ) ) )
+    for backend in BACKENDS:
+        if( backend == 'simplejpeg' and simplejpeg is None ):
+            print( '{:32s} not installed'.format(backend) )
+            continue
+        decoder = JpegDecoder( backend )
+        for scale in [1, 2, 4]:
+            bench( '{} scale 1/{}'.format(backend, scale), lambda: decoder.decode( b, scale ) )
+        bench( '{} roi 224x224'.format(backend), lambda: decoder.decode_roi( b, roi ) )
+    print( 'turbojpeg roi crop:', 'yes' if JpegDecoder().turbo is not None else 'not available' )
@@ -0,0 +1,114 @@
+import os
+import mmap
+import collections
+import numpy as np
+from multiprocessing import shared_memory
+
+# zmq_mode 5: frames in shared memory, for a client on the same machine
+#
+# segment layout
+#   seq     slots * Q   sequence number of the frame in each slot
+#   frames  slots * slot_size bytes, starting at a 64 byte boundary
+#
+# The client copies a frame into the next slot and sends only where it is
+# (util.protocol.pack_slot); the server maps the segment once and reads the
+# frame in place. A slot is reused after `slots` frames, so the ring must be
+# larger than the number of frames in flight; the sequence number tells the
+# server when that was not the case. A client that replaces its segment keeps
+# the old one until the frames in flight in it are answered.
+#
+# Any peer could name any file in /dev/shm, so servers take zmq_mode 5 only on
+# their ipc endpoint (util.server).
+
+class FrameRing:
+    '''
+    Producer side: owns the segment and unlinks it on close().
+    '''
+    def __init__( self, slots=8, slot_size=1280*720*3 ):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.table = -(-8*slots // 64) * 64
+        self.shm = shared_memory.SharedMemory( create=True, size=self.table + slots*slot_size )
+        self.seqs = np.ndarray( (slots,), dtype='<u8', buffer=self.shm.buf )
+        self.seq = 0
+
+    @property
+    def name( self ):
+        return self.shm.name
+
+    def put( self, np_array ):
+        '''
+        Copy np_array into the next slot.
+        -> (C-contiguous view of the copy, slot, offset, seq)
+        '''
+        if( np_array.nbytes > self.slot_size ):
+            raise ValueError( 'frame of {} bytes does not fit a {} byte slot'.format(np_array.nbytes, self.slot_size) )
+        self.seq += 1
+        slot = self.seq % self.slots
+        offset = self.table + slot * self.slot_size
+        dst = np.ndarray( np_array.shape, dtype=np_array.dtype, buffer=self.shm.buf, offset=offset )
+        dst[...] = np_array
+        self.seqs[slot] = self.seq
+        return dst, slot, offset, self.seq
+
+    def close( self ):
+        if( self.shm is not None ):
+            self.seqs = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+class FrameReader:
+    '''
+    Consumer side: maps each client's segment once, read-only, and frames
+    are read in place. Clients make a new segment when their frames grow, so
+    only the max_segments most recently used stay mapped; the mapping of an
+    older one goes once no frame read from it is referenced anymore.
+
+    The segment is mapped from /dev/shm rather than through SharedMemory,
+    whose resource tracker would unlink it when this process exits although
+    the client owns it.
+    '''
+    def __init__( self, shm_dir='/dev/shm', max_segments=8 ):
+        self.shm_dir = shm_dir
+        self.max_segments = max_segments
+        self.segments = collections.OrderedDict()
+
+    def attach( self, name ):
+        name = name.lstrip('/')
+        buf = self.segments.get( name )
+        if( buf is not None ):
+            self.segments.move_to_end( name )
+            return buf
+
+        if( not name or '/' in name or name in ('.', '..') ):
+            raise ValueError( 'bad shm name {}'.format(name) )
+        fd = os.open( os.path.join( self.shm_dir, name ), os.O_RDONLY )
+        try:
+            buf = mmap.mmap( fd, 0, prot=mmap.PROT_READ )
+        finally:
+            os.close( fd )
+        self.segments[name] = buf
+        while( len(self.segments) > self.max_segments ):
+            self.detach( next( iter( self.segments ) ) )
+        return buf
+
+    def detach( self, name ):
+        buf = self.segments.pop( name.lstrip('/'), None )
+        if( buf is None ):
+            return
+        try:
+            buf.close()
+        except BufferError:
+            pass # frames still point into it, it is unmapped with the last of them
+
+    def close( self ):
+        for name in list( self.segments ):
+            self.detach( name )
+
+    def get( self, name, slot, offset, seq, header ):
+        buf = self.attach( name )
+        if( np.frombuffer( buf, dtype='<u8', count=1, offset=8*slot )[0] != seq ):
+            raise ValueError( 'shm slot {} was reused before it was read'.format(slot) )
+        return np.ndarray( header['shape'], dtype=header['dtype'], buffer=buf,
+                           offset=offset, strides=header['strides'] )
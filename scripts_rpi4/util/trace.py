@@ -0,0 +1,96 @@
+import sys
+import time
+import threading
+import collections
+import numpy as np
+
+# Per-stage latency of one judgement
+#
+#   client: capture -> encode -> send -> ... -> receive, total, judge
+#   server: recv -> decode -> detect -> preprocess -> forward -> predict -> reply
+#
+# The server keeps a timestamp at the end of each stage (its own clock) for
+# the request being handled and, when the request asks for a trace, returns
+# them with the reply. The client moves them to its clock with the offset
+# estimated during the hello and turns them into stage durations.
+
+SERVER_STAGES = ( 'recv', 'decode', 'detect', 'preprocess', 'forward', 'predict', 'reply' )
+STAGES = ( 'capture', 'encode', 'send' ) + SERVER_STAGES[1:] + ( 'receive', 'total', 'judge' )
+
+_local = threading.local()
+
+def begin():
+    # a request has been received
+    _local.stamps = { 'recv': time.time() }
+
+def mark( stage ):
+    # stage of the current request is done; no-op outside a request
+    stamps = getattr( _local, 'stamps', None )
+    if( stamps is not None ):
+        stamps[stage] = time.time()
+
+def stamps():
+    return dict( getattr( _local, 'stamps', None ) or {} )
+
+def durations( stamps ):
+    '''
+    {stage: end time} -> [(stage, seconds)] in SERVER_STAGES order,
+    each stage measured from the previous one that was stamped.
+    '''
+    out = []
+    prev = stamps.get('recv')
+    for stage in SERVER_STAGES[1:]:
+        t = stamps.get(stage)
+        if( t is None or prev is None ):
+            continue
+        out.append( (stage, t - prev) )
+        prev = t
+    return out
+
+def estimate_offset( samples ):
+    '''
+    samples: [(t_send, t_server, t_recv)] of hello round trips.
+    -> server clock - client clock, from the sample with the shortest
+    round trip (error at most half of it), and that round trip.
+    '''
+    t0, ts, t1 = min( samples, key=lambda s: s[2] - s[0] )
+    return ts - (t0 + t1) / 2, t1 - t0
+
+class LatencyStats:
+    '''
+    Rolling latency histograms: the last `window` samples [s] of every stage.
+    '''
+    def __init__( self, window=1000 ):
+        self.window = window
+        self.samples = {}
+        self.counts = collections.Counter()
+
+    def add( self, stage, t ):
+        q = self.samples.get( stage )
+        if( q is None ):
+            q = collections.deque( maxlen=self.window )
+            self.samples[stage] = q
+        q.append( t )
+        self.counts[stage] += 1
+
+    def add_stamps( self, stamps ):
+        for stage, t in durations( stamps ):
+            self.add( stage, t )
+
+    def percentiles( self, q=(50, 95, 99) ):
+        # {stage: (samples, p50, p95, p99)}, stages in pipeline order
+        order = [ s for s in STAGES if s in self.samples ] + \
+            sorted( s for s in self.samples if not s in STAGES )
+        return collections.OrderedDict(
+            ( s, ( self.counts[s], *np.percentile( self.samples[s], q ) ) ) for s in order )
+
+    def dump( self, title='latency', file=sys.stdout ):
+        if( not self.samples ):
+            return
+        print( '----- {} [ms] (last {}) -----'.format( title, self.window ), file=file )
+        print( '{:12s} {:>8s} {:>9s} {:>9s} {:>9s}'.format( 'stage', 'n', 'p50', 'p95', 'p99' ), file=file )
+        for stage, (n, p50, p95, p99) in self.percentiles().items():
+            print( '{:12s} {:8d} {:9.2f} {:9.2f} {:9.2f}'.format( stage, n, p50*1000, p95*1000, p99*1000 ), file=file )
+
+# requests traced by this process (server side)
+stats = LatencyStats()
@@ -7,12 +7,11 @@ import random
 # https://ja.laptopwide.com/260598-how-to-get-the-latest-MUTWDL
 
 class webcam:
-    def __init__( self, device=0, frame_width=1280, frame_height=720, n_grab=2 ):
+    def __init__( self, device=0, frame_width=1280, frame_height=720, n_grab=2, fps=10 ):
         self.device = device
         self.capture = cv2.VideoCapture(self.device)
-        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
-        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
-        self.capture.set(cv2.CAP_PROP_FPS, 10)
+        self.set_size( frame_width, frame_height )
+        self.capture.set(cv2.CAP_PROP_FPS, fps)
         self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         self.__ret = None
         self.n_grab = n_grab
@@ -24,6 +23,12 @@ class webcam:
     def __del__( self ):
         self.capture.release()
 
+    def set_size( self, frame_width, frame_height ):
+        # the camera may pick the nearest mode it supports
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+        self.size = (frame_width, frame_height)
+
     def get_img( self ):
         for i in range(self.n_grab):
             self.capture.grab()
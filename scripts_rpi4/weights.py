@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+import io
+import os
+import json
+import time
+import hashlib
+import inspect
+import yaml
+import torch
+from torch import nn
+
+# Local store of the img2feat backbones
+#
+# img2feat builds every backbone from torchvision with pretrained=True, so each
+# CNN(network) finds and deserializes the weights again (and downloads them on
+# a fresh box). This script saves the built network of each backbone once, as
+# model/weights/<sha256>.pt with model/weights/index.json mapping the network
+# name to the file. stored_cnn() loads it without network access and without
+# the pretrained weights of torchvision. The file is a pickled nn.Module, so
+# unpickling it still imports the torchvision model classes.
+#
+# With torch >= 2.1 the file is loaded with torch.load(mmap=True): no copy of
+# the weights, and the processes on the box that use the same backbone share
+# its pages in the page cache. The pinned torch 1.13 has no mmap loading, so
+# there each process reads the whole file into its own memory and the load
+# is not faster than a read; these benefits need torch >= 2.1.
+#
+# load_backbone() uses the store when the network is in it, and img2feat
+# otherwise. It also applies the input size (img_size) and the feature tap
+# (features) of config/default.yaml: the backbone cut after an earlier module
+# and globally average pooled. Heads trained on such features are saved as
+# model/<name>_<variant>.pkl, see variant().
+#
+# img2feat (and torchvision with it) is imported only where a backbone is
+# built, so the naming helpers cost nothing to the exported runtimes.
+
+DIRECTORY = 'model/weights'
+
+# torch.load(mmap=True) is torch >= 2.1
+MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def read_index(directory=DIRECTORY):
+    # -> {network: {'sha256', 'dim_feature', 'bytes'}}
+    filename = os.path.join(directory, 'index.json')
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_atomic(filename, data, mode='wb'):
+    # readers never see a partly written file
+    tmp = filename + '.tmp{}'.format(os.getpid())
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def store(network, directory=DIRECTORY):
+    # build the backbone through img2feat (needs the torchvision weights once)
+    # and add it to the store -> sha256
+    from img2feat import CNN
+    os.makedirs(directory, exist_ok=True)
+    net = CNN(network)
+    buffer = io.BytesIO()
+    torch.save(net._CNN__network, buffer)
+    data = buffer.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+
+    # a file that is mapped keeps its old pages when it is replaced
+    write_atomic(os.path.join(directory, digest + '.pt'), data)
+    index = read_index(directory)
+    index[network] = {'sha256': digest, 'dim_feature': net.dim_feature, 'bytes': len(data)}
+    write_atomic(os.path.join(directory, 'index.json'), json.dumps(index, indent=2), 'w')
+    return digest
+
+
+def verify(directory=DIRECTORY):
+    # -> networks whose file is missing or does not match its hash
+    bad = []
+    for network, entry in read_index(directory).items():
+        filename = os.path.join(directory, entry['sha256'] + '.pt')
+        h = hashlib.sha256()
+        try:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        except OSError:
+            bad.append(network)
+            continue
+        if h.hexdigest() != entry['sha256']:
+            bad.append(network)
+    return bad
+
+
+def stored_cnn(network, directory=DIRECTORY, img_size=(224, 224), batch_size=128):
+    '''
+    img2feat.CNN running a backbone from the store: same preprocessing,
+    batching and output, the network is memory-mapped from the file
+    (torch >= 2.1, read into memory otherwise).
+    '''
+    from img2feat import CNN
+    entry = read_index(directory)[network]
+    filename = os.path.join(directory, entry['sha256'] + '.pt')
+    if MMAP:
+        module = torch.load(filename, mmap=True, weights_only=False)
+    else:
+        module = torch.load(filename)
+    for p in module.parameters():
+        p.requires_grad = False
+    module.eval()
+
+    # CNN.__init__ would build the network through torchvision first; its
+    # private attributes are set here instead
+    net = CNN.__new__(CNN)
+    net._CNN__gpu = False
+    net._CNN__img_size = tuple(img_size)
+    net._CNN__network = module
+    net._CNN__dim_feature = entry['dim_feature']
+    net.batch_size = batch_size
+    return net
+
+
+def feature_tap(params, network):
+    # module path the features of `network` are taken after (None: img2feat's pooled output)
+    return (params.get('features') or {}).get(network)
+
+
+def variant(network, params):
+    # network, feature tap and input size, as model files are named
+    name = network
+    feature = feature_tap(params, network)
+    if feature:
+        name += '_' + feature.replace('.', '-')
+    if params.get('img_size', 224) != 224:
+        name += '_{}'.format(params['img_size'])
+    return name
+
+
+def model_filename(params, network):
+    return 'model/' + params['name'] + '_' + variant(network, params) + '.pkl'
+
+
+def cut(module, path):
+    # Sequential `module` up to and including the submodule at path ('0.denseblock3')
+    if not isinstance(module, nn.Sequential):
+        raise ValueError('can not cut {} at {}, it is not a Sequential'.format(type(module).__name__, path))
+    name, _, rest = path.partition('.')
+    children = list(module.named_children())
+    names = [n for n, m in children]
+    if name not in names:
+        raise ValueError('no module {} in {}'.format(name, names))
+    k = names.index(name)
+    last = children[k][1] if not rest else cut(children[k][1], rest)
+    return nn.Sequential(*[m for n, m in children[:k]], last)
+
+
+def tap(net, feature):
+    # features of net taken after module `feature`, globally average pooled
+    network = nn.Sequential(cut(net._CNN__network, feature), nn.AdaptiveAvgPool2d(output_size=(1, 1))).eval()
+    w, h = net.img_size
+    with torch.no_grad():
+        dim_feature = network(torch.zeros(1, 3, h, w)).flatten(1).shape[1]
+    net._CNN__network = network
+    net._CNN__dim_feature = dim_feature
+    return net
+
+
+def load_backbone(network, directory=DIRECTORY, img_size=224, feature=None):
+    # float backbone for `network`, from the store if it is there
+    if isinstance(img_size, int):
+        img_size = (img_size, img_size)
+    if network in read_index(directory):
+        net = stored_cnn(network, directory, img_size)
+    else:
+        from img2feat import CNN
+        print('{} is not in {}, built by img2feat (python scripts_rpi4/weights.py adds it)'.format(network, directory))
+        net = CNN(network, img_size=img_size)
+    if feature:
+        net = tap(net, feature)
+    return net
+
+
+if (__name__ == '__main__'):
+    # load params
+    params = None
+    with open('config/default.yaml') as f:
+        params = yaml.safe_load(f)
+    wparams = params['weights']
+    directory = wparams['directory']
+
+    # missing or damaged backbones are (re)built, once with network access
+    index = read_index(directory)
+    bad = verify(directory)
+    for network in wparams['networks']:
+        if network in index and network not in bad:
+            continue
+        print("--- store {} ---".format(network))
+        print('sha256', store(network, directory))
+
+    print("--- load [ms] ---")
+    for network, entry in sorted(read_index(directory).items()):
+        t0 = time.time()
+        stored_cnn(network, directory)
+        print('{:12s} {:8.1f} MB  {}  {:8.1f}'.format(
+            network, entry['bytes'] / 1e6, entry['sha256'][:12], (time.time() - t0) * 1000))